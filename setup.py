@@ -88,5 +88,11 @@ if __name__ == "__main__":
             'dev': doc_requirements + test_requirements,
         },
 
+        entry_points={
+            'console_scripts': [
+                'compile_od_matrices=vivarium_population_spenser.population.od_matrices:main',
+            ],
+        },
+
         zip_safe=False,
     )
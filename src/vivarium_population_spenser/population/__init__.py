@@ -4,3 +4,5 @@ from .mortality import Mortality
 from .emigration import Emigration
 from .immigration import ImmigrationDeterministic
 from .internal_migration import InternalMigration
+from .internal_inmigration import InternalInMigration
+from .competing_risks import CompetingRisks
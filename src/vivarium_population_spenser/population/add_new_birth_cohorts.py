@@ -11,11 +11,41 @@ import numpy as np
 
 from vivarium_population_spenser import utilities
 from vivarium_population_spenser.population.data_transformations import get_live_births_per_year
+from vivarium_population_spenser.population.rate_cubes import build_rate_table
 
 # TODO: Incorporate better data into gestational model (probably as a separate component)
 PREGNANCY_DURATION = pd.Timedelta(days=9 * utilities.DAYS_PER_MONTH)
 
 
+def fertility_window(age, last_birth_time, time, fertile_ages):
+    """When each woman can next give birth and when she leaves the fertile ages.
+
+    Parameters
+    ----------
+    age : pandas.Series
+        The age of each woman at `time`.
+    last_birth_time : pandas.Series
+        The time of her last birth, NaT if she has not given birth.
+    time : pandas.Timestamp
+        The current time.
+    fertile_ages : (float, float)
+        The ages with non zero fertility rates, [start, end).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The ``eligible_from`` and ``eligible_until`` times of each woman.
+    """
+    def in_years(years):
+        return pd.to_timedelta(years * utilities.DAYS_PER_YEAR, unit='D')
+
+    enters = time + in_years(fertile_ages[0] - age)
+    after_pregnancy = (last_birth_time + PREGNANCY_DURATION).fillna(enters)
+    return pd.DataFrame({'eligible_from': enters.where(enters > after_pregnancy, after_pregnancy),
+                         'eligible_until': time + in_years(fertile_ages[1] - age)},
+                        index=age.index)
+
+
 class FertilityDeterministic:
     """Deterministic model of births."""
 
@@ -144,6 +174,15 @@ class FertilityAgeSpecificRates:
     A simulant-specific model for fertility and pregnancies.
     """
 
+    configuration_defaults = {
+        'age_specific_fertility': {
+            # 'lookup' interpolates the rates with a vivarium lookup table and 'cube' compiles them into
+            # a dense array indexed by sex, LAD, ethnicity, integer age and year. 'cells' interpolates
+            # them once per sex, LAD, ethnicity and integer age and broadcasts them to the simulants
+            'rate_table': 'lookup',
+        }
+    }
+
     @property
     def name(self):
         return 'age_specific_fertility'
@@ -158,27 +197,41 @@ class FertilityAgeSpecificRates:
         """
 
         age_specific_fertility_rate = builder.data.load("covariate.age_specific_fertility_rate.estimate")
-        fertility_rate = builder.lookup.build_table(age_specific_fertility_rate,
-                                                    key_columns=['sex', 'location', 'ethnicity'],
-                                                    parameter_columns=['age', 'year'])
+        fertility_rate = build_rate_table(builder, age_specific_fertility_rate,
+                                          builder.configuration.age_specific_fertility.rate_table)
 
         self.fertility_rate = builder.value.register_rate_producer('fertility rate',
                                                                    source=fertility_rate,
                                                                    requires_columns=['sex', 'location', 'ethnicity'])
 
         self.randomness = builder.randomness.get_stream('fertility')
+        self.clock = builder.time.clock()
+
+        # Women are indexed by when they can next give birth and when they leave the ages with
+        # non zero rates, so each step only evaluates the rates of the women who can give birth.
+        fertile = age_specific_fertility_rate[(age_specific_fertility_rate.sex == 2)
+                                              & (age_specific_fertility_rate.mean_value > 0)]
+        self.fertile_ages = (fertile.age_start.min(), fertile.age_end.max()) if len(fertile) else None
+        self.eligibility = pd.DataFrame({'eligible_from': pd.Series(dtype='datetime64[ns]'),
+                                         'eligible_until': pd.Series(dtype='datetime64[ns]')})
+        # simulants whose sex is only assigned after this component initializes them
+        self.unknown_sex = pd.Index([])
 
         self.population_view = builder.population.get_view(['last_birth_time', 'sex', 'parent_id','ethnicity', 'location','age','MSOA'])
         self.simulant_creator = builder.population.get_simulant_creator()
 
         builder.population.initializes_simulants(self.on_initialize_simulants,
                                                  creates_columns=['last_birth_time', 'parent_id'],
-                                                 requires_columns=['sex'])
+                                                 requires_columns=['sex', 'ethnicity', 'location', 'age', 'MSOA'])
 
         builder.event.register_listener('time_step', self.on_time_step)
 
     def on_initialize_simulants(self, pop_data):
-        """ Adds 'last_birth_time' and 'parent' columns to the state table."""
+        """ Adds 'last_birth_time' and 'parent' columns to the state table.
+
+        New born babies also inherit the location, ethnicity and MSOA of their mother, passed
+        in the user data, and get their sex and age.
+        """
         pop = self.population_view.subview(['sex']).get(pop_data.index)
         women = pop.loc[pop.sex == 2].index
 
@@ -193,8 +246,42 @@ class FertilityAgeSpecificRates:
         # and none of them have had a child in the last year.
         pop_update.loc[women, 'last_birth_time'] = pop_data.creation_time - pd.Timedelta(days=utilities.DAYS_PER_YEAR)
 
+        if 'parent_attributes' in pop_data.user_data:
+            # assign sex, ethnicity and location to the new born babies in this time step
+            parents = pop_data.user_data['parent_attributes']
+            pop_update['location'] = parents['location'].to_numpy()
+            pop_update['ethnicity'] = parents['ethnicity'].to_numpy()
+            pop_update['MSOA'] = parents['MSOA'].to_numpy()
+            pop_update['sex'] = self.randomness.choice(pop_data.index, [1.0, 2.0], additional_key='sex_choice')
+            pop_update['age'] = 0.0
+
         self.population_view.update(pop_update)
 
+        pop = self.population_view.subview(['sex', 'age', 'last_birth_time']).get(pop_data.index)
+        self.unknown_sex = self.unknown_sex.union(pop.index[pop.sex.isnull()])
+        self.index_women(pop[pop.sex == 2], pop_data.creation_time)
+
+    def index_women(self, women, time):
+        """Adds women to the eligibility index, unless they are past the fertile ages."""
+        if self.fertile_ages is None or women.empty:
+            return
+        window = fertility_window(women.age, women.last_birth_time, time, self.fertile_ages)
+        window = window[window.eligible_until > time]
+        self.eligibility = pd.concat([self.eligibility.drop(window.index, errors='ignore'), window])
+
+    def get_eligible_women(self, time):
+        """Living women who can give birth at `time`, dropping from the index the ones who never will again."""
+        if self.unknown_sex.size:
+            pop = self.population_view.subview(['sex', 'age', 'last_birth_time']).get(self.unknown_sex)
+            self.unknown_sex = pd.Index([])
+            self.index_women(pop[pop.sex == 2], self.clock())
+
+        self.eligibility = self.eligibility[self.eligibility.eligible_until > time]
+        candidates = self.eligibility.index[self.eligibility.eligible_from < time]
+        eligible_women = self.population_view.get(candidates, query='alive == "alive"')
+        self.eligibility = self.eligibility.drop(candidates.difference(eligible_women.index))
+        return eligible_women
+
     def on_time_step(self, event):
         """Produces new children and updates parent status on time steps.
         Parameters
@@ -202,17 +289,15 @@ class FertilityAgeSpecificRates:
         event : vivarium.population.PopulationEvent
             The event that triggered the function call.
         """
-        # Get a view on all living women who haven't had a child in at least nine months.
-        nine_months_ago = pd.Timestamp(event.time - PREGNANCY_DURATION)
-        population = self.population_view.get(event.index, query='alive == "alive" and sex == 2')
-        can_have_children = population.last_birth_time < nine_months_ago
-        eligible_women = population[can_have_children]
+        # Get a view on the living women of fertile age who haven't had a child in at least nine months.
+        eligible_women = self.get_eligible_women(event.time)
 
         rate_series = self.fertility_rate(eligible_women.index)
         had_children = self.randomness.filter_for_rate(eligible_women, rate_series).copy()
 
         had_children.loc[:, 'last_birth_time'] = event.time
         self.population_view.update(had_children['last_birth_time'])
+        self.eligibility.loc[had_children.index, 'eligible_from'] = event.time + PREGNANCY_DURATION
 
         # If children were born, add them to the state table and record
         # who their mother was.
@@ -223,23 +308,10 @@ class FertilityAgeSpecificRates:
                                       'age_start': 0,
                                       'age_end': 0,
                                       'sim_state': 'time_step',
-                                      'parent_ids': had_children.index
+                                      'parent_ids': had_children.index,
+                                      'parent_attributes': had_children[['location', 'ethnicity', 'MSOA']],
                                   })
 
-            # assign sex, ethnicity and location to the new born babies in this time step
-            new_babies = self.population_view.get(event.index+num_babies, query='alive == "alive" and parent_id != -1 and sex == "nan"')
-
-            if new_babies.shape[0] != 0:
-
-                new_babies['location'] = self.population_view.get(event.index).iloc[new_babies['parent_id']]['location'].values
-                new_babies['ethnicity'] = self.population_view.get(event.index).iloc[new_babies['parent_id']]['ethnicity'].values
-                new_babies['MSOA'] = self.population_view.get(event.index).iloc[new_babies['parent_id']]['MSOA'].values
-
-                new_babies['sex'] = self.randomness.choice(new_babies.index, [1.0, 2.0], additional_key='sex_choice')
-                new_babies['age'] = 0.0
-
-                self.population_view.update(new_babies[['location','ethnicity','sex','age','MSOA']])
-
     def load_age_specific_fertility_rate_data(self, builder):
         asfr_data = builder.data.load("covariate.age_specific_fertility_rate.estimate")
         columns = ['year_start', 'year_end', 'location', 'ethnicity', 'age_start', 'age_end', 'mean_value']
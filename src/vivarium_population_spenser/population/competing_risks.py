@@ -0,0 +1,81 @@
+"""
+=========================
+The Competing Risks Model
+=========================
+
+This module contains a transition engine that draws, in one pass over the living
+population, which of the exits and moves of the other components happens to each
+simulant in a time step. Components taking part provide their rates with
+``transition_rates(pop, event)`` and apply the outcomes drawn for them with
+``apply_transitions(pop, outcome, event)``.
+
+"""
+import numpy as np
+import pandas as pd
+
+NO_TRANSITION = 'no_transition'
+
+
+def competing_risks_probabilities(rates):
+    """Probability of each transition, and of none, when the rates compete over a time step.
+
+    The probability of any transition is ``1 - exp(-total rate)`` and it is shared out among
+    the transitions in proportion to their rates.
+
+    Parameters
+    ----------
+    rates : pandas.DataFrame
+        The rate of each transition over the time step, one column per transition.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The probability of each transition and, in the `NO_TRANSITION` column, of none.
+    """
+    total = rates.sum(axis=1)
+    any_transition = 1 - np.exp(-total)
+    probabilities = rates.div(total.where(total > 0, 1.), axis=0).mul(any_transition, axis=0)
+    probabilities[NO_TRANSITION] = 1 - any_transition
+    return probabilities
+
+
+class CompetingRisks:
+    """Draws the exits and moves of all the transition components with a single draw per simulant.
+
+    Without it, `Mortality`, `Emigration` and `InternalMigration` each read the living
+    population and draw their own outcome at the same priority, so the outcome of a simulant
+    depends on the order the components run in. When this component is part of the
+    simulation they do not listen to time steps themselves: the population is read once, the
+    rates of every component compete and the outcomes are handed back to their components.
+    """
+
+    @property
+    def name(self):
+        return 'competing_risks'
+
+    def setup(self, builder):
+        self.transition_components = [component for component in builder.components.list_components().values()
+                                      if hasattr(component, 'transition_rates')]
+        view_columns = ['alive', 'sex']
+        for component in self.transition_components:
+            view_columns += [column for column in component.transition_columns if column not in view_columns]
+
+        self.randomness = builder.randomness.get_stream('competing_risks')
+        self.population_view = builder.population.get_view(view_columns)
+
+        builder.event.register_listener('time_step', self.on_time_step, priority=0)
+
+    def on_time_step(self, event):
+        pop = self.population_view.get(event.index, query="alive =='alive' and sex != 'nan'")
+
+        component_rates = [component.transition_rates(pop, event) for component in self.transition_components]
+        probabilities = competing_risks_probabilities(pd.concat(component_rates, axis=1))
+        outcome = self.randomness.choice(probabilities.index, probabilities.columns, probabilities)
+
+        for component, rates in zip(self.transition_components, component_rates):
+            component_outcome = outcome[outcome.isin(rates.columns)]
+            if not component_outcome.empty:
+                component.apply_transitions(pop.loc[component_outcome.index].copy(), component_outcome, event)
+
+    def __repr__(self):
+        return "CompetingRisks()"
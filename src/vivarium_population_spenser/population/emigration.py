@@ -10,17 +10,37 @@ import pandas as pd
 
 from vivarium.framework.utilities import rate_to_probability
 
+from vivarium_population_spenser.population.competing_risks import CompetingRisks
+from vivarium_population_spenser.population.event_scheduling import SCHEDULING_MODES, NextEventScheduler
+from vivarium_population_spenser.population.rate_cubes import build_rate_table
+
 
 class Emigration:
 
+    # columns the competing risks engine reads for this component
+    transition_columns = []
+
+    configuration_defaults = {
+        'emigration': {
+            # 'lookup' interpolates the rates with a vivarium lookup table and 'cube' compiles them into
+            # a dense array indexed by sex, LAD, ethnicity, integer age and year. 'cells' interpolates
+            # them once per sex, LAD, ethnicity and integer age and broadcasts them to the simulants
+            'rate_table': 'lookup',
+            # 'step' draws whether each living simulant transitions in every time step, 'next_event'
+            # draws the time of the transition of each simulant whenever their rates change and
+            # only handles the transitions due in each time step
+            'scheduling': 'step',
+        }
+    }
+
     @property
     def name(self):
         return 'emigration'
 
     def setup(self, builder):
         emigration_data = builder.data.load("covariate.age_specific_migration_rate.estimate")
-        self.all_cause_emigration_rate = builder.lookup.build_table(emigration_data, key_columns=['sex', 'location', 'ethnicity'],
-                                                                    parameter_columns=['age', 'year'])
+        self.all_cause_emigration_rate = build_rate_table(builder, emigration_data,
+                                                          builder.configuration.emigration.rate_table)
 
 
         self.emigration_rate = builder.value.register_rate_producer('emigration_rate',
@@ -37,25 +57,54 @@ class Emigration:
         builder.population.initializes_simulants(self.on_initialize_simulants,
                                                  creates_columns=columns_created)
 
-        builder.event.register_listener('time_step', self.on_time_step, priority=0)
+        self.scheduling = builder.configuration.emigration.scheduling
+        if self.scheduling not in SCHEDULING_MODES:
+            raise ValueError(f'Unknown scheduling {self.scheduling}. Use one of {SCHEDULING_MODES}.')
+        competing_risks = builder.components.get_components_by_type(CompetingRisks)
+        if competing_risks and self.scheduling == 'next_event':
+            raise ValueError('The next_event scheduling can not be used with the competing risks component.')
+        self.scheduler = None
+        if self.scheduling == 'next_event':
+            self.scheduler = NextEventScheduler(self.population_view.subview(['alive', 'sex', 'age', 'location']),
+                                                self.emigration_rate, self.random, self.clock)
+
+        if not competing_risks:
+            builder.event.register_listener('time_step', self.on_time_step, priority=0)
 
     def on_initialize_simulants(self, pop_data):
         pop_update = pd.DataFrame({'emigrated': 'no_emigration'},
                                   index=pop_data.index)
         self.population_view.update(pop_update)
 
+        if self.scheduler is not None:
+            self.scheduler.add_simulants(pop_data.index)
+
     def on_time_step(self, event):
+        if self.scheduler is not None:
+            outcome = self.scheduler.due_transitions(event)
+            if not outcome.empty:
+                self.apply_transitions(self.population_view.get(outcome.index), outcome, event)
+            return
+
         pop = self.population_view.get(event.index, query="alive =='alive' and sex != 'nan'")
         prob_df = rate_to_probability(pd.DataFrame(self.emigration_rate(pop.index)))
         prob_df['no_emigration'] = 1-prob_df.sum(axis=1)
         prob_df['emigrated'] = self.random.choice(prob_df.index, prob_df.columns, prob_df)
-        emigrated_pop = prob_df.query('emigrated != "no_emigration"').copy()
+        emigrated_pop = prob_df.query('emigrated != "no_emigration"')
 
         if not emigrated_pop.empty:
-            emigrated_pop['alive'] = pd.Series('emigrated', index=emigrated_pop.index)
-            emigrated_pop['emigrated'] = pd.Series('Yes', index=emigrated_pop.index)
-            emigrated_pop['exit_time'] = event.time
-            self.population_view.update(emigrated_pop[['alive', 'exit_time', 'emigrated']])
+            self.apply_transitions(pop.loc[emigrated_pop.index].copy(), emigrated_pop['emigrated'], event)
+
+    def transition_rates(self, pop, event):
+        """The emigration rates of `pop`, competing with the other transitions."""
+        return pd.DataFrame(self.emigration_rate(pop.index))
+
+    def apply_transitions(self, emigrated_pop, outcome, event):
+        """Records the emigration of `emigrated_pop` at `event.time`."""
+        emigrated_pop['alive'] = pd.Series('emigrated', index=emigrated_pop.index)
+        emigrated_pop['emigrated'] = pd.Series('Yes', index=emigrated_pop.index)
+        emigrated_pop['exit_time'] = event.time
+        self.population_view.update(emigrated_pop[['alive', 'exit_time', 'emigrated']])
 
     def calculate_emigration_rate(self, index):
         emigration_rate = self.all_cause_emigration_rate(index)
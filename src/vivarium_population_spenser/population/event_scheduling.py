@@ -0,0 +1,237 @@
+"""
+================
+Event Scheduling
+================
+
+This module contains tools to schedule the transitions of constant hazard, such as death
+and emigration, as events. The rates of a simulant only change on their birthday and at the
+start of a year, so the time to their transition is drawn whenever their rate changes and
+each time step only handles the events due by its end, instead of drawing whether every
+living simulant transitions in every step.
+
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from vivarium_population_spenser import utilities
+
+SCHEDULING_MODES = ['step', 'next_event']
+NANOSECONDS_PER_YEAR = pd.Timedelta(days=utilities.DAYS_PER_YEAR).value
+
+
+def hazard_change_times(age, time):
+    """The time the rates of each simulant next change, at their birthday or the start of a year.
+
+    Parameters
+    ----------
+    age : numpy.ndarray
+        The age of each simulant at `time`.
+    time : numpy.ndarray
+        Times, in nanoseconds since the epoch.
+
+    Returns
+    -------
+    numpy.ndarray
+        The time of the next change, in nanoseconds since the epoch.
+    """
+    age = np.asarray(age, dtype=float)
+    time = np.asarray(time, dtype=np.int64)
+    birthday = time + ((np.floor(age) + 1 - age) * NANOSECONDS_PER_YEAR).astype(np.int64)
+    next_year = pd.to_datetime(pd.DataFrame({'year': pd.DatetimeIndex(time).year + 1, 'month': 1, 'day': 1}))
+    return np.minimum(birthday, next_year.to_numpy().astype('datetime64[ns]').astype(np.int64))
+
+
+def grow(array, size, fill):
+    """`array` extended with `fill` to at least `size` elements, doubling its length."""
+    if size <= len(array):
+        return array
+    extended = np.full(max(size, 2 * len(array)), fill, dtype=array.dtype)
+    extended[:len(array)] = array
+    return extended
+
+
+class EventQueue:
+    """The pending event of each simulant, in arrays sorted by due time.
+
+    Each simulant has at most one pending event, either its transition or the next change of
+    its rates. Scheduling a new event for a simulant supersedes the previous one, which stays
+    in the arrays until it is due or the arrays are compacted, and is skipped. Simulants are
+    the integer positions of the state table, and every operation is vectorised over the
+    simulants scheduled or due.
+    """
+
+    def __init__(self):
+        self._times = np.zeros(0, dtype=np.int64)
+        self._simulants = np.zeros(0, dtype=np.int64)
+        self._entries = np.zeros(0, dtype=np.int64)
+        self._is_transition = np.zeros(0, dtype=bool)
+        # the entry of the pending event of each simulant, -1 if it has none
+        self._current = np.zeros(0, dtype=np.int64)
+        self._next_entry = 0
+        self._n_events = 0
+
+    def __len__(self):
+        return self._n_events
+
+    def schedule(self, simulants, times, is_transition):
+        """Queues the event of each simulant at the given time, in nanoseconds since the epoch."""
+        simulants = np.asarray(simulants, dtype=np.int64)
+        if not len(simulants):
+            return
+        times = np.asarray(times, dtype=np.int64)
+        entries = self._next_entry + np.arange(len(simulants), dtype=np.int64)
+        self._next_entry += len(simulants)
+
+        self._current = grow(self._current, simulants.max() + 1, -1)
+        self._n_events += int((self._current[simulants] < 0).sum())
+        self._current[simulants] = entries
+
+        order = np.argsort(times, kind='stable')
+        position = np.searchsorted(self._times, times[order], side='right')
+        self._times = np.insert(self._times, position, times[order])
+        self._simulants = np.insert(self._simulants, position, simulants[order])
+        self._entries = np.insert(self._entries, position, entries[order])
+        self._is_transition = np.insert(self._is_transition, position, np.asarray(is_transition, dtype=bool)[order])
+        if len(self._times) > 2 * self._n_events + 1024:
+            self._compact()
+
+    def _compact(self):
+        pending = self._current[self._simulants] == self._entries
+        self._times, self._simulants = self._times[pending], self._simulants[pending]
+        self._entries, self._is_transition = self._entries[pending], self._is_transition[pending]
+
+    def pop_due(self, time):
+        """Removes the events due by `time` from the queue.
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            The simulant, time and whether it is a transition of each event, in order of time.
+        """
+        due = np.searchsorted(self._times, pd.Timestamp(time).value, side='right')
+        times, simulants = self._times[:due], self._simulants[:due]
+        entries, is_transition = self._entries[:due], self._is_transition[:due]
+        self._times, self._simulants = self._times[due:], self._simulants[due:]
+        self._entries, self._is_transition = self._entries[due:], self._is_transition[due:]
+
+        pending = self._current[simulants] == entries
+        simulants = simulants[pending]
+        self._current[simulants] = -1
+        self._n_events -= len(simulants)
+        return simulants, times[pending], is_transition[pending]
+
+    def __repr__(self):
+        return f"EventQueue(events={len(self)})"
+
+
+class NextEventScheduler:
+    """Draws the time of the transition of each simulant and hands out the transitions due in each step.
+
+    When the rates of a simulant change, the time to its transition is drawn from an exponential
+    distribution of their new total rate. If it falls before their rates change again the
+    transition is queued, otherwise the change is, and the time is drawn again from there. The
+    rates can only be read at the age and year of the start of a time step, so the time from a
+    change within a step is drawn at the start of the next step, from the rates after the
+    change. A transition falling between the change and the start of that step is handed out
+    in that step, one step late. The rates also change when a simulant moves to another LAD,
+    so the time of simulants whose location changed since it was drawn is drawn again at the
+    start of the next step.
+
+    Parameters
+    ----------
+    population_view : vivarium.framework.population.PopulationView
+        A view on the alive, sex, age and location columns.
+    rate : vivarium.framework.values.Pipeline
+        The rate producer of the transitions, its columns are the possible outcomes.
+    randomness : vivarium.framework.randomness.RandomnessStream
+        The randomness stream of the transitions.
+    clock : callable
+        The simulation clock.
+    """
+
+    def __init__(self, population_view, rate, randomness, clock):
+        self.population_view = population_view
+        self.rate = rate
+        self.randomness = randomness
+        self.clock = clock
+        self.queue = EventQueue()
+        # simulants whose transition is drawn at the next time step, once all their columns are set
+        self.unscheduled = pd.Index([], dtype=np.int64)
+        # simulants whose rates changed within the last time step, and the time of the change
+        self.changed = pd.Index([], dtype=np.int64)
+        self.change_times = np.zeros(0, dtype=np.int64)
+        # the location of each simulant when their next event was drawn
+        self.locations = np.full(0, None, dtype=object)
+
+    def add_simulants(self, index):
+        self.unscheduled = self.unscheduled.append(index)
+
+    def schedule(self, index, start, step_size, additional_key):
+        """Draws the next event of the living simulants of `index`, from `start` in nanoseconds."""
+        pop = self.population_view.get(index, query="alive == 'alive' and sex != 'nan'")
+        start = pd.Series(start, index=index).loc[pop.index].to_numpy()
+        now = pd.Timestamp(self.clock()).value
+
+        yearly_rate = pd.DataFrame(self.rate(pop.index)).sum(axis=1).to_numpy() / utilities.to_years(step_size)
+        u = self.randomness.get_draw(pop.index, additional_key=f'time_to_event_{additional_key}').to_numpy()
+        with np.errstate(divide='ignore'):
+            time_to_event = -np.log1p(-u) / yearly_rate * NANOSECONDS_PER_YEAR
+
+        age = pop['age'].to_numpy() + (start - now) / NANOSECONDS_PER_YEAR
+        # at least a nanosecond, so that rounding at a birthday cannot schedule a change at `start` again
+        time_to_change = np.maximum(hazard_change_times(age, start) - start, 1)
+        is_transition = time_to_event < time_to_change
+        time_to_event = np.where(is_transition, time_to_event, time_to_change).astype(np.int64)
+        self.queue.schedule(pop.index, start + time_to_event, is_transition)
+        if len(pop):
+            self.locations = grow(self.locations, pop.index.max() + 1, None)
+            self.locations[pop.index.to_numpy()] = pop['location'].to_numpy()
+
+    def moved_simulants(self, index):
+        """The living simulants of `index` whose location changed since their next event was drawn."""
+        location = self.population_view.get(index, query="alive == 'alive' and sex != 'nan'")['location']
+        drawn = location.index[location.index < len(self.locations)]
+        recorded = self.locations[drawn.to_numpy()]
+        moved = pd.notna(recorded) & (recorded != location.loc[drawn].to_numpy())
+        return drawn[moved]
+
+    def due_transitions(self, event):
+        """The outcome of each living simulant whose transition is due by the end of the time step."""
+        now = pd.Timestamp(self.clock()).value
+        # simulants who moved are drawn again from now, unless they are drawn already
+        moved = self.moved_simulants(event.index).difference(self.unscheduled.append(self.changed))
+        pending = self.unscheduled.append(moved).append(self.changed)
+        start = np.concatenate([np.full(len(self.unscheduled) + len(moved), now, dtype=np.int64), self.change_times])
+        self.unscheduled = pd.Index([], dtype=np.int64)
+        changed, change_times = [], []
+
+        transitions = []
+        for i in itertools.count():
+            if len(pending):
+                self.schedule(pending, start, event.step_size, i)
+            simulants, times, is_transition = self.queue.pop_due(event.time)
+            if not len(simulants):
+                break
+            transitions.append(simulants[is_transition])
+            # the rates of the others changed, draw again from the change once the rates after it are read
+            later = ~is_transition & (times > now)
+            changed.append(simulants[later])
+            change_times.append(times[later])
+            redraw = ~is_transition & ~later
+            pending, start = pd.Index(simulants[redraw]), times[redraw]
+
+        self.changed = pd.Index(np.concatenate(changed) if changed else [], dtype=np.int64)
+        self.change_times = np.concatenate(change_times) if change_times else np.zeros(0, dtype=np.int64)
+
+        due = pd.Index(np.concatenate(transitions) if transitions else [], dtype=np.int64)
+        pop = self.population_view.get(due, query="alive == 'alive'")
+        rates = pd.DataFrame(self.rate(pop.index))
+        if len(rates.columns) == 1:
+            return pd.Series(rates.columns[0], index=pop.index)
+        return self.randomness.choice(pop.index, rates.columns, rates.div(rates.sum(axis=1), axis=0),
+                                      additional_key='outcome')
+
+    def __repr__(self):
+        return f"NextEventScheduler(events={len(self.queue)})"
@@ -0,0 +1,275 @@
+"""
+=============
+Gravity Model
+=============
+
+This module contains a distance-decay destination model for internal migration. Rather
+than holding the MSOA x MSOA OD matrices, the destination of a migrant is drawn among the
+MSOAs closest to their origin, with probabilities proportional to
+``attractiveness[j] * exp(-beta * distance[i, j])`` computed when migrants are sampled.
+The attractiveness of each MSOA and the distance decay are calibrated on an OD matrix, so
+the memory held scales with the number of MSOAs times the number of candidates.
+
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+from vivarium_population_spenser.population.od_matrices import (DestinationSampler, normalise_csr_rows,
+                                                                  segment_positions)
+
+
+def read_MSOA_centroids(path):
+    """Reads the MSOA population weighted centroids csv into a MSOA code -> X, Y frame, in metres."""
+    centroids = pd.read_csv(path, encoding='utf-8-sig')
+    return centroids.set_index('msoa01cd')[['X', 'Y']]
+
+
+def fill_MSOA_centroids(centroids, MSOA_LAD):
+    """The centroid of each MSOA, taking the mean centroid of its LAD for MSOAs without one.
+
+    The centroids are the ones of the 2001 MSOAs, so the MSOAs created in 2011 do not have
+    one and are placed at the mean centroid of the other MSOAs of their LAD.
+
+    Parameters
+    ----------
+    centroids : pandas.DataFrame
+        The X and Y coordinates of each MSOA code, as read by `read_MSOA_centroids`.
+    MSOA_LAD : pandas.Series
+        The LAD code of each MSOA code.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The X and Y coordinates of each MSOA of `MSOA_LAD`, in the same order.
+    """
+    located = centroids.reindex(MSOA_LAD.index)
+    LAD_centroids = located.groupby(MSOA_LAD.to_numpy()).mean()
+    missing = located['X'].isna()
+    if missing.any():
+        fallback = LAD_centroids.reindex(MSOA_LAD[missing].to_numpy())
+        if fallback['X'].isna().any():
+            unlocated = MSOA_LAD[missing].index[fallback['X'].isna().to_numpy()]
+            raise ValueError(f'MSOAs {list(unlocated)} have no centroid and neither has any MSOA of their LAD.')
+        located.loc[missing] = fallback.to_numpy()
+    return located
+
+
+class MSOANeighbours:
+    """Candidate destinations of each MSOA, either its k nearest MSOAs or those within a radius.
+
+    The candidates are stored in CSR layout: the candidates of MSOA ``i`` are
+    ``indices[indptr[i]:indptr[i + 1]]`` and their distance from it, in km, is the same slice
+    of ``distances``. Every MSOA is one of its own candidates.
+
+    Parameters
+    ----------
+    coordinates : numpy.ndarray
+        n x 2 centroid coordinates, in km.
+    indptr : numpy.ndarray
+        Row pointers into `indices`, of length ``n + 1``.
+    indices : numpy.ndarray
+        Candidate MSOA positions.
+    distances : numpy.ndarray
+        Distance to each candidate, in km.
+    """
+
+    def __init__(self, coordinates, indptr, indices, distances):
+        self.coordinates = coordinates
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+
+    @classmethod
+    def from_centroids(cls, centroids, k=100, radius=None):
+        """Finds the candidates of each MSOA with a KD-tree over their centroids.
+
+        Parameters
+        ----------
+        centroids : numpy.ndarray or pandas.DataFrame
+            n x 2 centroid coordinates of the MSOAs, in metres.
+        k : int
+            Number of nearest MSOAs kept as candidates.
+        radius : float, optional
+            If set, all the MSOAs within this many km are kept instead of the k nearest.
+        """
+        coordinates = np.asarray(centroids, dtype=float) / 1000.
+        n = len(coordinates)
+        tree = cKDTree(coordinates)
+        if radius is not None:
+            neighbours = tree.query_ball_point(coordinates, r=radius)
+            lengths = np.array([len(candidates) for candidates in neighbours], dtype=np.int64)
+            indices = np.concatenate([np.sort(candidates) for candidates in neighbours]).astype(np.int64)
+            origins = np.repeat(np.arange(n), lengths)
+            distances = np.hypot(*(coordinates[indices] - coordinates[origins]).T)
+        else:
+            k = min(k, n)
+            distances, indices = tree.query(coordinates, k=k)
+            lengths = np.full(n, k, dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return cls(coordinates, indptr, np.ravel(indices).astype(np.int32), np.ravel(distances).astype(np.float32))
+
+    @property
+    def n_origins(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.coordinates, self.indptr, self.indices, self.distances])
+
+
+class GravityDestinationSampler:
+    """Destination sampler of a gravity model over the candidates of each origin MSOA.
+
+    The destination distribution of origin ``i`` is proportional to
+    ``attractiveness[j] * exp(-beta * distance[i, j])`` over the candidates ``j`` of ``i``.
+    It is computed for the origins of the migrants each time they are sampled and never
+    stored. The neighbours are shared by all the samplers built on them.
+
+    Parameters
+    ----------
+    neighbours : MSOANeighbours
+        The candidate destinations of each origin.
+    attractiveness : numpy.ndarray
+        Attractiveness of each destination MSOA.
+    beta : float
+        Distance decay, per km.
+    """
+
+    def __init__(self, neighbours, attractiveness, beta):
+        self.neighbours = neighbours
+        self.attractiveness = attractiveness
+        self.beta = beta
+
+    @classmethod
+    def from_matrix(cls, matrix, neighbours):
+        """Calibrates the gravity model on an OD matrix.
+
+        The attractiveness of an MSOA is its total inflow in the row-normalised matrix, and the
+        distance decay is set so that the mean distance moved from the origins with flows
+        matches the one of the matrix (see `calibrate_distance_decay`).
+        """
+        rates = normalise_csr_rows(scipy.sparse.csr_matrix(matrix))
+        # keep a tiny attractiveness everywhere so that every candidate can be drawn
+        attractiveness = np.asarray(rates.sum(axis=0)).ravel() + 1e-10
+        beta = calibrate_distance_decay(rates, neighbours, attractiveness)
+        return cls(neighbours, attractiveness, beta)
+
+    @property
+    def n_origins(self):
+        return self.neighbours.n_origins
+
+    @property
+    def n_destinations(self):
+        return len(self.attractiveness)
+
+    @property
+    def nbytes(self):
+        """Memory held by the sampler, in bytes, without the shared neighbours."""
+        return self.attractiveness.nbytes
+
+    def rows_sampler(self, rows):
+        """A DestinationSampler of the gravity model distributions of the given origin rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.neighbours.indptr[rows], self.neighbours.indptr[rows + 1]
+        position = segment_positions(starts, ends)
+        indices = self.neighbours.indices[position]
+        distances = self.neighbours.distances[position].astype(float)
+
+        weights = gravity_weights(self.attractiveness[indices], distances, self.beta, ends - starts)
+        indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+        matrix = scipy.sparse.csr_matrix((weights, indices, indptr), shape=(len(rows), self.n_destinations))
+        return DestinationSampler.from_matrix(matrix)
+
+    def sample(self, rows, u):
+        unique_rows, row_index = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+        return self.rows_sampler(unique_rows).sample(row_index.ravel(), u)
+
+    def probabilities(self, rows):
+        return self.rows_sampler(rows).probabilities(np.arange(len(rows)))
+
+
+def gravity_weights(attractiveness, distances, beta, lengths):
+    """The unnormalised gravity model weight of each candidate, for candidates stored by origin.
+
+    The decay is taken from the distance of the nearest candidate of each origin, which scales
+    the weights of an origin by the same factor but keeps its nearest candidate from
+    underflowing. The far candidates may still underflow to 0, which is ignored even when
+    numpy is set to raise on underflow, as vivarium does.
+
+    Parameters
+    ----------
+    attractiveness : numpy.ndarray
+        Attractiveness of each candidate.
+    distances : numpy.ndarray
+        Distance to each candidate, in km.
+    beta : float
+        Distance decay, per km.
+    lengths : numpy.ndarray
+        Number of candidates of each origin, at least one.
+    """
+    if not len(distances):
+        return np.zeros(0)
+    nearest = np.minimum.reduceat(distances, np.cumsum(lengths) - lengths)
+    with np.errstate(under='ignore'):
+        return attractiveness * np.exp(-beta * (distances - np.repeat(nearest, lengths)))
+
+
+def expected_distance(neighbours, attractiveness, beta, origins):
+    """Mean over `origins` of the expected distance moved under the gravity model."""
+    starts, ends = neighbours.indptr[origins], neighbours.indptr[origins + 1]
+    position = segment_positions(starts, ends)
+    distances = neighbours.distances[position].astype(float)
+    weights = gravity_weights(attractiveness[neighbours.indices[position]], distances, beta, ends - starts)
+
+    segment = np.repeat(np.arange(len(origins)), ends - starts)
+    total = np.bincount(segment, weights, minlength=len(origins))
+    with np.errstate(under='ignore'):
+        moved = np.bincount(segment, weights * distances, minlength=len(origins))
+        return np.mean(moved / total)
+
+
+def calibrate_distance_decay(rates, neighbours, attractiveness, tolerance=1e-6, max_beta=100.):
+    """Finds the distance decay whose mean distance moved matches the one of an OD matrix.
+
+    The expected distance of the model decreases with the decay, so it is found by bisection.
+    When the matrix moves people further than the model can with no decay at all, which can
+    happen when the candidates are truncated, the decay is 0.
+
+    Parameters
+    ----------
+    rates : scipy.sparse.csr_matrix
+        Row-normalised OD matrix.
+    neighbours : MSOANeighbours
+        The candidate destinations of each origin.
+    attractiveness : numpy.ndarray
+        Attractiveness of each destination MSOA.
+    tolerance : float
+        Width of the final bisection interval, per km.
+    max_beta : float
+        Upper bound of the decay, per km.
+
+    Returns
+    -------
+    float
+        The distance decay, per km.
+    """
+    flows = rates.tocoo()
+    if not flows.nnz:
+        return 0.
+    coordinates = neighbours.coordinates
+    observed = np.hypot(*(coordinates[flows.row] - coordinates[flows.col]).T)
+    origins = np.flatnonzero(np.diff(rates.indptr) > 0)
+    target = np.sum(flows.data * observed) / np.sum(flows.data)
+
+    low, high = 0., max_beta
+    if expected_distance(neighbours, attractiveness, low, origins) <= target:
+        return low
+    while high - low > tolerance:
+        beta = (low + high) / 2
+        if expected_distance(neighbours, attractiveness, beta, origins) > target:
+            low = beta
+        else:
+            high = beta
+    return (low + high) / 2
@@ -10,11 +10,74 @@ Currently, we have a deterministic immigration component in which:
 """
 import pandas as pd
 import numpy as np
+import scipy.sparse
+from vivarium.framework.time import get_time_stamp
 from vivarium_population_spenser import utilities
+from vivarium_population_spenser.population.od_matrices import DestinationSampler, OD_age_bucket_codes, OD_SEX_MAP
+
+# age buckets of the columns of the immigration to MSOA table, <sex>_<age bucket>, in the order of the OD age bins
+IMMIGRATION_AGE_BUCKETS = ["0_4", "5_15", "16_19", "20_24", "25_34", "35_49", "50_64", "65_74", "75plus"]
+IMMIGRATION_SEXES = sorted(OD_SEX_MAP)
+
+
+def build_immigration_MSOA_sampler(immigration_to_MSOA):
+    """Compiles the immigration to MSOA table into one MSOA distribution per (LAD, sex, age bucket).
+
+    The distribution of a LAD is over its own MSOAs, weighted by the immigrant counts of the
+    sex and age bucket column plus ``1e-10`` so that buckets without immigrants are spread
+    uniformly. The row of a cell is ``(LAD * len(IMMIGRATION_SEXES) + sex) *
+    len(IMMIGRATION_AGE_BUCKETS) + age bucket``, with positions in the returned LAD index,
+    `IMMIGRATION_SEXES` and `IMMIGRATION_AGE_BUCKETS`.
+
+    Returns
+    -------
+    (DestinationSampler, pandas.Index, numpy.ndarray)
+        The sampler, the LAD codes and the MSOA code of each destination column.
+    """
+    LAD_codes, LADs = pd.factorize(immigration_to_MSOA['LAD.Code'])
+    columns = [f'{OD_SEX_MAP[sex]}_{age_bucket}' for sex in IMMIGRATION_SEXES for age_bucket in IMMIGRATION_AGE_BUCKETS]
+    counts = immigration_to_MSOA[columns].to_numpy(dtype=float) + 1e-10
+
+    n_MSOAs, n_groups = counts.shape
+    rows = LAD_codes[:, None] * n_groups + np.arange(n_groups)
+    MSOAs = np.repeat(np.arange(n_MSOAs)[:, None], n_groups, axis=1)
+    matrix = scipy.sparse.csr_matrix((counts.ravel(), (rows.ravel(), MSOAs.ravel())),
+                                     shape=(len(LADs) * n_groups, n_MSOAs))
+    return DestinationSampler.from_matrix(matrix), pd.Index(LADs), immigration_to_MSOA['MSOA'].to_numpy()
+
+
+def arrival_counts(simulants_per_year, step_size, first_step, n_steps):
+    """Immigrants arriving in each of `n_steps` time steps, starting after `first_step` steps.
+
+    The fractional immigrants of a step are carried over to the next, so the first k steps of
+    the run bring ``floor(k * simulants_per_year * step_size)`` immigrants in total.
+
+    Parameters
+    ----------
+    simulants_per_year : float
+        The number of immigrants per year.
+    step_size : float
+        The time step, in years.
+    first_step : int
+        The number of time steps before the first one counted.
+    n_steps : int
+        The number of time steps counted.
+    """
+    steps = np.arange(first_step, first_step + n_steps + 1)
+    return np.diff(np.floor(steps * simulants_per_year * step_size)).astype(np.int64)
 
 
 class ImmigrationDeterministic:
 
+    configuration_defaults = {
+        'immigration': {
+            # 'step' samples the immigrants of each time step as they arrive, 'year' and 'run'
+            # generate the arrivals and attributes of a whole year, or of the whole run, in one
+            # batch and inject the immigrants due in each time step
+            'arrival_schedule': 'step',
+        }
+    }
+
     @property
     def name(self):
         return "deterministic_immigration"
@@ -26,16 +89,43 @@ class ImmigrationDeterministic:
         self.simulants_per_year = builder.data.load("cause.all_causes.cause_specific_total_immigrants_per_year") 
         self.immigration_to_MSOA = builder.data.load("cause.all_causes.immigration_to_MSOA")
 
+        # integer coded (sex, ethnicity, location, age) of the immigrants, drawn with an alias table
+        self.immigrant_sampler = utilities.AliasSampler(self.asfr_data_immigration['mean_value'])
+        self.immigrant_sex = self.asfr_data_immigration['sex'].to_numpy().astype(float)
+        self.immigrant_ethnicity = self.asfr_data_immigration['ethnicity'].to_numpy()
+        self.immigrant_location = self.asfr_data_immigration['location'].to_numpy()
+        self.immigrant_age = self.asfr_data_immigration['age_start'].to_numpy().astype(float)
+        self.randomness = builder.randomness.get_stream('immigrant_attributes')
+        self.immigration_MSOA_sampler, self.immigration_LADs, self.immigration_MSOAs = \
+            build_immigration_MSOA_sampler(self.immigration_to_MSOA)
+
+        self.arrival_schedule = builder.configuration.immigration.arrival_schedule
+        if self.arrival_schedule not in ['step', 'year', 'run']:
+            raise ValueError(f'Unknown arrival schedule {self.arrival_schedule}. Use one of "step", "year" or "run".')
+        self.clock = builder.time.clock()
+        self.step_size = builder.time.step_size()
+        self.end_time = get_time_stamp(builder.configuration.time.end)
+        # immigrants generated ahead of time and the offsets of the ones due in each step
+        self.scheduled_immigrants = None
+        self.scheduled_offsets = np.zeros(1, dtype=np.int64)
+        self.scheduled_step = 0
+        self.steps_scheduled = 0
+
         self.simulant_creator = builder.population.get_simulant_creator()
         self.population_view = builder.population.get_view(['immigrated', 'sex', 'ethnicity', 'location', 'age','MSOA'])
         builder.population.initializes_simulants(self.on_initialize_simulants,
-                                                 creates_columns=["immigrated"])
+                                                 creates_columns=["immigrated"],
+                                                 requires_columns=['sex', 'ethnicity', 'location', 'age', 'MSOA'])
         builder.event.register_listener('time_step', self.on_time_step)
 
     def on_initialize_simulants(self, pop_data):
-        if pop_data.user_data['sim_state'] == 'time_step_imm':
-            pop_update = pd.DataFrame({'immigrated': 'Yes'},
-                                    index=pop_data.index)
+        if pop_data.user_data.get('sim_state') == 'time_step_imm':
+            # the immigrants created this step, their attributes are written here so no
+            # other component has to find them in the state table
+            if 'immigrants' in pop_data.user_data:
+                pop_update = pop_data.user_data['immigrants'].set_axis(pop_data.index)
+            else:
+                pop_update = self.sample_immigrants(pop_data.index)
         else:
             pop_update = pd.DataFrame({'immigrated': 'no_immigration'},
                                     index=pop_data.index)
@@ -51,6 +141,10 @@ class ImmigrationDeterministic:
         event
             The event that triggered the function call.
         """
+        if self.arrival_schedule != 'step':
+            self.inject_scheduled_immigrants()
+            return
+
         # Assume immigrants are uniformly distributed throughout the year.
         step_size = utilities.to_years(event.step_size)
         simulants_to_add = self.simulants_per_year*step_size + self.fractional_new_immigrations
@@ -66,73 +160,79 @@ class ImmigrationDeterministic:
                                       'sim_state': 'time_step_imm',
                                       'immigrated': "Yes"
                                   })
-        
-        # XXX make sure this does not conflict with fertility XXX
-        new_residents = self.population_view.get(event.index+simulants_to_add,query='sex == "nan" and immigrated != "no_immigration"').copy()
-        
-        if len(new_residents) > 0:
-            # sample residents using the immigration rates
-            sample_resident = self.asfr_data_immigration.sample(len(new_residents), weights="mean_value", replace=True)
-            new_residents["sex"] = sample_resident["sex"].values.astype(float)
-            new_residents["ethnicity"] = sample_resident["ethnicity"].values
-            new_residents["location"] = sample_resident["location"].values
-            new_residents["age"] = sample_resident["age_start"].values.astype(float)
-            new_residents["immigrated"] = "Yes"
-
-            new_residents['MSOA'] = self.assign_MSOA(new_residents)
-
-            self.population_view.update(new_residents[['immigrated', 'location', 'ethnicity', 'sex', 'age','MSOA']])
-
-    def assign_MSOA(self,new_residents):
-        ''' Based on the characteristic individuals of the new residents, get the relevant
-         assign new MSOA and save the old ones in a new field
-         '''
-        int_migration_matrix_rate, int_migration_matrix_names = self.get_immigration_MSOA_rates(new_residents)
-
-        # Add a random seed for numpy
-        np.random.seed(64)
-
-        # sample the rates for each individual and get the new wards.
-        c = int_migration_matrix_rate.cumsum(axis=1)
-        u = np.random.rand(len(c), 1)
-        # get the new MSA
-        MSOA_choices = (u < c).argmax(axis=1)
-
-        # from the MSOA index get the new MSOA and LAD location name
-        MSOA_choices_name = int_migration_matrix_names[MSOA_choices]
-
-        return (MSOA_choices_name)
 
-    def get_OD_matrix_age_gender(self,new_residents):
+    def inject_scheduled_immigrants(self):
+        """Creates the scheduled immigrants due in this time step, scheduling the next batch first if needed."""
+        if self.scheduled_step >= len(self.scheduled_offsets) - 1:
+            self.schedule_immigrants()
 
-        cut_bins = [-1, 5, 16, 20, 25, 35, 50, 65, 75, 200]
-
-        cut_labels = ["0_4", "5_15", "16_19", "20_24", "25_34", "35_49", "50_64", "65_74", "75plus"]
-        new_residents.loc[:, "age_bucket"] = pd.cut(new_residents['age'], bins=cut_bins, labels=cut_labels)
-        # XXX recheck the sex_map
-        new_residents.loc[:, "sex_map"] = new_residents["sex"].map({1: 'M', 2: 'F'})
-        new_residents["MSOA_values"] = new_residents["sex_map"].astype(str) + "_" + new_residents["age_bucket"].astype(str)
+        start, end = self.scheduled_offsets[self.scheduled_step], self.scheduled_offsets[self.scheduled_step + 1]
+        self.scheduled_step += 1
+        if end > start:
+            self.simulant_creator(int(end - start),
+                                  population_configuration={
+                                      'age_start': 0,
+                                      'age_end': 100,
+                                      'sim_state': 'time_step_imm',
+                                      'immigrated': "Yes",
+                                      'immigrants': self.scheduled_immigrants.iloc[start:end],
+                                  })
 
+    def schedule_immigrants(self):
+        """Generates the immigrants of the time steps until the end of the year, or of the run, in one batch."""
+        now = self.clock()
+        horizon = self.end_time
+        if self.arrival_schedule == 'year':
+            horizon = min(horizon, pd.Timestamp(year=now.year + 1, month=1, day=1))
+        n_steps = max(int(np.ceil((horizon - now) / self.step_size())), 1)
+
+        counts = arrival_counts(self.simulants_per_year, utilities.to_years(self.step_size()),
+                                self.steps_scheduled, n_steps)
+        r = np.random.RandomState(seed=self.randomness.get_seed('arrival_schedule'))
+        u = r.random_sample((2, counts.sum()))
+
+        self.scheduled_immigrants = self.generate_immigrants(u[0], u[1])
+        self.scheduled_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.scheduled_step = 0
+        self.steps_scheduled += n_steps
+
+    def sample_immigrants(self, index):
+        """Samples the attributes of new immigrants from the immigration rates and assigns their MSOA."""
+        return self.generate_immigrants(self.randomness.get_draw(index).to_numpy(),
+                                        self.randomness.get_draw(index, additional_key='MSOA').to_numpy()).set_axis(index)
+
+    def generate_immigrants(self, u, u_MSOA):
+        """Decodes the immigrant attributes and MSOA of each pair of uniform draws over [0, 1)."""
+        codes = self.immigrant_sampler.sample(u)
+        new_residents = pd.DataFrame({'immigrated': 'Yes',
+                                      'location': self.immigrant_location[codes],
+                                      'ethnicity': self.immigrant_ethnicity[codes],
+                                      'sex': self.immigrant_sex[codes],
+                                      'age': self.immigrant_age[codes]})
+        new_residents['MSOA'] = self.assign_MSOA(new_residents, u_MSOA)
         return new_residents
 
-    def get_immigration_MSOA_rates(self,new_residents):
-
-        new_residents = self.get_OD_matrix_age_gender(new_residents)
-        LAD_name = np.unique(new_residents['location'])
-
-        if len(LAD_name)!=1:
-            raise RuntimeError('The immigration module only works on the individual LAD level')
+    def assign_MSOA(self, new_residents, u):
+        ''' Based on the characteristic individuals of the new residents, get the relevant
+         assign new MSOA and save the old ones in a new field
+         '''
+        rows = self.get_immigration_MSOA_rows(new_residents)
 
-        immigration_values = self.immigration_to_MSOA[self.immigration_to_MSOA['LAD.Code'].isin(LAD_name)][new_residents['MSOA_values']]
-        MSOA_order = self.immigration_to_MSOA.loc[immigration_values.index,'MSOA']
+        # sample the MSOA of each individual from the precomputed (LAD, sex, age bucket) distributions
+        MSOA_choices = self.immigration_MSOA_sampler.sample(rows, u)
 
-        immigration_values_t = immigration_values.transpose()
-        immigration_values_t += 1e-10
-        row_sum = immigration_values_t.sum(axis=1)
-        immigration_MSOA_rate = immigration_values_t / row_sum[:, None]
+        return self.immigration_MSOAs[MSOA_choices]
 
-        return np.array(immigration_MSOA_rate), MSOA_order.values
+    def get_immigration_MSOA_rows(self, new_residents):
+        """The row of the (LAD, sex, age bucket) MSOA distribution of each new resident."""
+        LAD = self.immigration_LADs.get_indexer(new_residents['location'])
+        if (LAD < 0).any():
+            unknown = new_residents['location'][LAD < 0].unique()
+            raise ValueError(f'LADs {list(unknown)} are not in the immigration to MSOA table.')
+        sex = np.searchsorted(IMMIGRATION_SEXES, new_residents['sex'].to_numpy().astype(np.int64))
+        age_bucket = OD_age_bucket_codes(new_residents['age'].to_numpy())
 
+        return (LAD * len(IMMIGRATION_SEXES) + sex) * len(IMMIGRATION_AGE_BUCKETS) + age_bucket
 
-def __repr__(self):
-        return "ImmigrationDeterministic()"
\ No newline at end of file
+    def __repr__(self):
+        return "ImmigrationDeterministic()"
@@ -0,0 +1,216 @@
+"""
+=================================
+The Internal In-migration Model
+=================================
+
+This module contains tools modeling the internal migrants that move into the study area
+from the rest of England & Wales. The origins are not simulated: the yearly flows into the
+MSOAs of the study area are read from the destination columns of the OD flow matrices, and
+in-migrants are created in a single batch per time step.
+
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from vivarium_population_spenser import utilities
+from vivarium_population_spenser.population.od_matrices import OD_AGE_BUCKETS, OD_SEX_MAP
+
+# ages of the in-migrants of each OD age bucket are drawn uniformly from [start, end)
+INMIGRANT_AGE_RANGES = {"0to4": (0, 5), "5to15": (5, 16), "16to19": (16, 20), "20to24": (20, 25),
+                        "25to34": (25, 35), "35to49": (35, 50), "50to64": (50, 65), "65to74": (65, 75),
+                        "75plus": (75, 90)}
+
+
+def external_inflow(OD_matrix, study_area_columns):
+    """Flows into each study area MSOA from the MSOAs outside the study area.
+
+    Only the destination columns of the study area are read, in CSC form, so the cost does not
+    depend on the number of origins with flows elsewhere.
+
+    Parameters
+    ----------
+    OD_matrix : scipy.sparse.spmatrix
+        Origin x destination flows.
+    study_area_columns : numpy.ndarray
+        The columns of the study area MSOAs, which are also their origin rows.
+
+    Returns
+    -------
+    numpy.ndarray
+        The inflow into each of the `study_area_columns`.
+    """
+    columns = scipy.sparse.csc_matrix(OD_matrix)[:, study_area_columns]
+    outside = np.ones(columns.shape[0], dtype=bool)
+    outside[study_area_columns] = False
+    return np.asarray(columns[outside].sum(axis=0), dtype=float).ravel()
+
+
+def sample_donors(resident_MSOA, MSOA, u):
+    """Picks a resident of the same MSOA for each in-migrant, or of any MSOA if theirs has none.
+
+    Parameters
+    ----------
+    resident_MSOA : numpy.ndarray
+        The MSOA of each resident.
+    MSOA : numpy.ndarray
+        The MSOA of each in-migrant.
+    u : numpy.ndarray
+        Draws from a uniform distribution over [0, 1), one per in-migrant.
+
+    Returns
+    -------
+    numpy.ndarray
+        The position in `resident_MSOA` of the donor of each in-migrant, -1 if there are no
+        residents.
+    """
+    if len(resident_MSOA) == 0:
+        return np.full(len(MSOA), -1, dtype=np.int64)
+    order = np.argsort(resident_MSOA, kind='stable')
+    codes, starts, counts = np.unique(np.asarray(resident_MSOA)[order], return_index=True, return_counts=True)
+    position = np.minimum(np.searchsorted(codes, MSOA), len(codes) - 1)
+    found = codes[position] == MSOA
+
+    start = np.where(found, starts[position], 0)
+    count = np.where(found, counts[position], len(order))
+    return order[start + np.floor(u * count).astype(np.int64)]
+
+
+class InternalInMigration:
+    """Creates the internal migrants moving into the study area from the rest of England & Wales.
+
+    The yearly flows of each OD matrix of the flow family into each study area MSOA form the
+    in-migration cells (sex, age bucket, MSOA). Each time step the number of in-migrants of
+    every cell is drawn from a Poisson distribution and all of them are created with one call
+    to the simulant creator. Their age is drawn within the age bucket, their LAD is the one of
+    their MSOA and their ethnicity is copied from a random resident of their MSOA. If no one
+    lives in the study area any more, it is copied from the residents when the flows were read.
+    """
+
+    configuration_defaults = {
+        'internal_inmigration': {
+            # the family of OD matrix files holding the yearly flows, <sex>_<age bucket>_<family>_EW.npz
+            'od_matrix_family': 'OD_matrix',
+            # LAD codes of the study area, defaults to the LADs of the initial population
+            'study_area': None,
+        }
+    }
+
+    @property
+    def name(self):
+        return 'internal_inmigration'
+
+    def setup(self, builder):
+        self.internal_migration_MSOA_location_dict = builder.data.load("internal_migration.MSOA_index")
+        self.internal_migration_LAD_location_dict = builder.data.load("internal_migration.LAD_index")
+        self.path_to_OD_matrices = builder.data.load("internal_migration.path_to_OD_matrices")
+
+        internal_inmigration_config = builder.configuration.internal_inmigration
+        self.OD_matrix_family = internal_inmigration_config.od_matrix_family
+        self.study_area = internal_inmigration_config.study_area
+        self.inflow = None
+        self.initial_residents = None
+        self.new_inmigrants = None
+
+        self.randomness = builder.randomness.get_stream('internal_inmigration')
+        self.simulant_creator = builder.population.get_simulant_creator()
+
+        columns_created = ['internal_inmigrated']
+        view_columns = columns_created + ['alive', 'age', 'sex', 'location', 'ethnicity', 'MSOA']
+        self.population_view = builder.population.get_view(view_columns)
+        builder.population.initializes_simulants(self.on_initialize_simulants,
+                                                 creates_columns=columns_created,
+                                                 requires_columns=['age', 'sex', 'location', 'ethnicity', 'MSOA'])
+
+        builder.event.register_listener('time_step', self.on_time_step)
+
+    def on_initialize_simulants(self, pop_data):
+        if pop_data.user_data.get('sim_state') != 'time_step_internal_inmigration':
+            self.population_view.update(pd.DataFrame({'internal_inmigrated': 'No'}, index=pop_data.index))
+            return
+
+        new_inmigrants = self.new_inmigrants.set_axis(pop_data.index)
+        self.new_inmigrants = None
+
+        # the ethnicity of the in-migrants is not in the flows, copy it from a resident of their MSOA
+        # new simulants are appended to the state table, so the residents come before them
+        residents = self.population_view.subview(['MSOA', 'ethnicity']).get(
+            pd.RangeIndex(pop_data.index.min()), query="alive == 'alive' and sex != 'nan'")
+        if residents.empty:
+            residents = self.initial_residents
+        if residents.empty:
+            raise ValueError('No residents to copy the ethnicity of the internal in-migrants from.')
+        donors = sample_donors(residents['MSOA'].to_numpy().astype(str), new_inmigrants['MSOA'].to_numpy(),
+                               self.randomness.get_draw(pop_data.index, additional_key='ethnicity').to_numpy())
+        new_inmigrants['ethnicity'] = residents['ethnicity'].to_numpy()[donors]
+
+        age_draw = self.randomness.get_draw(pop_data.index, additional_key='age')
+        new_inmigrants['age'] = new_inmigrants['age_start'] + age_draw * (new_inmigrants['age_end'] - new_inmigrants['age_start'])
+        new_inmigrants['internal_inmigrated'] = 'Yes'
+
+        self.population_view.update(new_inmigrants[['internal_inmigrated', 'age', 'sex', 'location',
+                                                    'ethnicity', 'MSOA']])
+
+    def on_time_step(self, event):
+        if self.inflow is None:
+            self.inflow = self.read_inflow(event.index)
+
+        # in-migrants of each cell over the step, the flows are yearly
+        step_size = utilities.to_years(event.step_size)
+        r = np.random.RandomState(seed=self.randomness.get_seed('internal_inmigrants'))
+        counts = r.poisson(self.inflow['inflow'].to_numpy() * step_size)
+        if counts.sum() == 0:
+            return
+
+        self.new_inmigrants = self.inflow.loc[self.inflow.index.repeat(counts)].reset_index(drop=True)
+        self.simulant_creator(int(counts.sum()),
+                              population_configuration={
+                                  'age_start': 0,
+                                  'age_end': 100,
+                                  'sim_state': 'time_step_internal_inmigration',
+                              })
+
+    def read_inflow(self, index):
+        """Reads the yearly flows into the study area MSOAs of every OD matrix of the flow family.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per cell with flows, with its sex, age range, MSOA, LAD and yearly inflow.
+        """
+        column_MSOA = pd.Series(self.internal_migration_MSOA_location_dict).sort_index()
+        # the LADs merged or recoded since the rates were made take the codes of the rates
+        column_LAD = pd.Series(utilities.map_missing_LAD(list(pd.Series(self.internal_migration_LAD_location_dict)
+                                                              .reindex(column_MSOA.index))),
+                               index=column_MSOA.index)
+        residents = self.population_view.get(index, query="alive == 'alive' and sex != 'nan'")
+        self.initial_residents = residents[['MSOA', 'ethnicity']]
+        study_area = self.study_area
+        if study_area is None:
+            study_area = residents['location'].unique()
+        study_area_columns = column_LAD.index[column_LAD.isin(utilities.map_missing_LAD(list(study_area)))].to_numpy()
+
+        cells = []
+        for sex, sex_code in {v: k for k, v in OD_SEX_MAP.items()}.items():
+            for age_bucket in OD_AGE_BUCKETS:
+                file = os.path.join(self.path_to_OD_matrices, f'{sex}_{age_bucket}_{self.OD_matrix_family}_EW.npz')
+                if not os.path.exists(file):
+                    continue
+                inflow = external_inflow(scipy.sparse.load_npz(file), study_area_columns)
+                age_start, age_end = INMIGRANT_AGE_RANGES[age_bucket]
+                cells.append(pd.DataFrame({'sex': float(sex_code),
+                                           'age_start': float(age_start),
+                                           'age_end': float(age_end),
+                                           'MSOA': column_MSOA[study_area_columns].to_numpy(),
+                                           'location': column_LAD[study_area_columns].to_numpy(),
+                                           'inflow': inflow}))
+        if not cells:
+            raise ValueError(f'No *_{self.OD_matrix_family}_EW.npz OD matrices in {self.path_to_OD_matrices}.')
+
+        inflow = pd.concat(cells, ignore_index=True)
+        return inflow[inflow['inflow'] > 0].reset_index(drop=True)
+
+    def __repr__(self):
+        return "InternalInMigration()"
@@ -6,16 +6,156 @@ The Core InternalMigration Model
 This module contains tools modeling InternalMigration
 
 """
+from functools import partial
 import glob
 import scipy
 import pandas as pd
 import numpy as np
 from vivarium.framework.utilities import rate_to_probability
 from vivarium_population_spenser.utilities import map_missing_LAD
+from vivarium_population_spenser.population.competing_risks import CompetingRisks
+from vivarium_population_spenser.population.rate_cubes import build_rate_table
+from vivarium_population_spenser.population.gravity_model import (GravityDestinationSampler, MSOANeighbours,
+                                                                    fill_MSOA_centroids, read_MSOA_centroids)
+from vivarium_population_spenser.population.od_matrices import (OD_PRECISIONS, OD_STORE_FILE, DestinationSampler,
+                                                                  HierarchicalDestinationSampler, LazyODMatrices,
+                                                                  ODMatrixFile,
+                                                                  OriginSubsetSampler, OD_age_bucket_codes,
+                                                                  build_OD_matrix_lookup, compile_OD_store,
+                                                                  gather_probabilities, read_OD_store,
+                                                                  sample_destination_counts, sample_destinations,
+                                                                  TruncatedDestinationSampler, YearlyODMatrices)
 import os
 
+
+class MigrationEventLog:
+    """Append-only, columnar log of internal migration events.
+
+    Each event records the simulant, the time of the move and the MSOA and LAD they moved
+    from and to. Locations are held as integer codes into the locations seen so far and each
+    time step appends one chunk of arrays, so recording costs O(migrants) and the history is
+    never stored in, or copied with, the state table.
+    """
+
+    columns = ['simulant_id', 'time', 'from_MSOA', 'to_MSOA', 'from_LAD', 'to_LAD']
+
+    def __init__(self):
+        self._chunks = []
+        self._locations = {'MSOA': pd.Index([]), 'LAD': pd.Index([])}
+
+    def __len__(self):
+        return sum(len(chunk['simulant_id']) for chunk in self._chunks)
+
+    def _encode(self, level, locations):
+        locations = np.asarray(locations, dtype=object)
+        codes = self._locations[level].get_indexer(locations)
+        if (codes < 0).any():
+            self._locations[level] = self._locations[level].append(pd.Index(pd.unique(locations[codes < 0])))
+            codes = self._locations[level].get_indexer(locations)
+        return codes.astype(np.int32)
+
+    def record(self, simulant_id, time, from_MSOA, to_MSOA, from_LAD, to_LAD):
+        """Appends the moves of a group of simulants that migrated at `time`."""
+        simulant_id = np.asarray(simulant_id, dtype=np.int64)
+        self._chunks.append({'simulant_id': simulant_id,
+                             'time': np.full(len(simulant_id), np.datetime64(pd.Timestamp(time)), dtype='M8[ns]'),
+                             'from_MSOA': self._encode('MSOA', from_MSOA),
+                             'to_MSOA': self._encode('MSOA', to_MSOA),
+                             'from_LAD': self._encode('LAD', from_LAD),
+                             'to_LAD': self._encode('LAD', to_LAD)})
+
+    def to_frame(self):
+        """The events as a DataFrame, in the order they were recorded, with categorical locations."""
+        if not self._chunks:
+            columns = {column: np.array([], dtype=np.int32) for column in self.columns}
+            columns['simulant_id'] = np.array([], dtype=np.int64)
+            columns['time'] = np.array([], dtype='M8[ns]')
+        else:
+            columns = {column: np.concatenate([chunk[column] for chunk in self._chunks]) for column in self.columns}
+            # consolidate, so later calls do not concatenate again
+            self._chunks = [columns]
+
+        events = pd.DataFrame({'simulant_id': columns['simulant_id'], 'time': columns['time']})
+        for column in self.columns[2:]:
+            level = column.split('_')[1]
+            events[column] = pd.Categorical.from_codes(columns[column], categories=self._locations[level])
+        return events
+
+    def history(self, simulant_ids):
+        """The events of the given simulants."""
+        events = self.to_frame()
+        return events[events['simulant_id'].isin(simulant_ids)]
+
+    def export(self, path):
+        """Writes the events to a csv file."""
+        self.to_frame().to_csv(path, index=False)
+
+    def __repr__(self):
+        return f"MigrationEventLog(events={len(self)})"
+
+
+def second_stage(sampler):
+    """The LAD pair -> MSOA stage of a hierarchical or truncated destination sampler."""
+    if isinstance(sampler, TruncatedDestinationSampler):
+        return sampler.residual_sampler.MSOA_sampler
+    return sampler.MSOA_sampler
+
+
 class InternalMigration:
 
+    # columns the competing risks engine reads for this component
+    transition_columns = ['age', 'sex', 'location', 'MSOA', 'last_outmigration_time']
+
+    configuration_defaults = {
+        'internal_migration': {
+            # 'dense' densifies every OD matrix, 'sparse' keeps them as CSR so memory
+            # scales with the number of non-zero flows and 'memmap' maps a compiled store
+            # of the probability matrices that is shared by every process on the node.
+            'od_matrix_storage': 'dense',
+            # the family of OD matrix files, <sex>_<age bucket>_<family>_EW.npz, used to assign destinations
+            'od_matrix_family': 'prob_matrix',
+            # read each OD matrix the first time a migrant needs it instead of at setup, holding
+            # at most max_loaded_od_matrices of them (all of them if None)
+            'lazy_od_matrices': False,
+            'max_loaded_od_matrices': None,
+            # only hold the OD rows of the MSOAs simulants live in, starting from the initial
+            # population and growing as simulants move. It can not be used with the memmap
+            # storage or the gravity destination sampler.
+            'origin_subset': False,
+            # 'msoa' draws destinations straight from the MSOA rows of the OD matrices,
+            # 'hierarchical' draws a destination LAD and then an MSOA within it, exactly within the
+            # LAD of the origin and from the inflows from the LAD of the origin elsewhere (a mean
+            # total variation distance of 0.09 to the exact rows on F_25to34_prob_matrix),
+            # 'truncated' only holds the top_k_destinations of each origin and resolves the rest
+            # at LAD level (0.03 with 20 destinations), and
+            # 'gravity' draws it among the nearest MSOAs with a distance-decay model calibrated
+            # on the OD matrices
+            'destination_sampler': 'msoa',
+            'top_k_destinations': 20,
+            # candidates of the gravity model, the gravity_neighbours nearest MSOAs or, if
+            # gravity_radius is set, all the MSOAs within gravity_radius km
+            'gravity_neighbours': 100,
+            'gravity_radius': None,
+            # storage of the destination CDFs, 'float64', 'float32' or fixed point 'uint16',
+            # the error of each destination probability is at most 1.2e-7 and 1.5e-5 respectively
+            'od_matrix_precision': 'float64',
+            # 'individual' draws the destination of each migrant on its own, 'multinomial' draws
+            # the destination counts of all the migrants of an origin MSOA and OD matrix at once
+            'destination_assignment': 'individual',
+            # read year-specific OD matrices from the <year> subdirectories of the OD matrices
+            # directory, swapping them at each year boundary. Next year's matrices are read on a
+            # background thread while the current year runs.
+            'yearly_od_matrices': False,
+            # csv file the migration event log is written to at the end of the simulation
+            'migration_log_path': None,
+            # 'lookup' interpolates the out-migration rates with a vivarium lookup table and 'cube'
+            # compiles them into a dense array indexed by sex, LAD, ethnicity, integer age and year.
+            # 'cells' interpolates them once per sex, LAD, ethnicity and integer age and broadcasts
+            # them to the simulants
+            'rate_table': 'lookup',
+        }
+    }
+
     @property
     def name(self):
         return 'integralmigration'
@@ -31,38 +171,89 @@ class InternalMigration:
         self.MSOA_LAD_indices = builder.data.load("internal_migration.MSOA_LAD_indices")
 
         self.path_to_OD_matrices = builder.data.load("internal_migration.path_to_OD_matrices") 
-
-        self.int_out_migration_rate = builder.lookup.build_table(int_outmigration_data, 
-                                                                 key_columns=['sex', 'location', 'ethnicity'],
-                                                                 parameter_columns=['age', 'year'])
+        internal_migration_config = builder.configuration.internal_migration
+        self.OD_matrix_storage = internal_migration_config.od_matrix_storage
+        self.OD_matrix_family = internal_migration_config.od_matrix_family
+        self.lazy_OD_matrices = internal_migration_config.lazy_od_matrices
+        self.max_loaded_OD_matrices = internal_migration_config.max_loaded_od_matrices
+        self.destination_sampler = internal_migration_config.destination_sampler
+        self.top_k_destinations = internal_migration_config.top_k_destinations
+        self.origin_subset = internal_migration_config.origin_subset
+        self.OD_matrix_precision = internal_migration_config.od_matrix_precision
+        self.destination_assignment = internal_migration_config.destination_assignment
+        self.yearly_OD_matrices = internal_migration_config.yearly_od_matrices
+        self.migration_log_path = internal_migration_config.migration_log_path
+        if self.OD_matrix_storage not in ['dense', 'sparse', 'memmap']:
+            raise ValueError(f'Unknown OD matrix storage {self.OD_matrix_storage}. '
+                             f'Use one of "dense", "sparse" or "memmap".')
+        if self.destination_sampler not in ['msoa', 'hierarchical', 'truncated', 'gravity']:
+            raise ValueError(f'Unknown destination sampler {self.destination_sampler}. '
+                             f'Use one of "msoa", "hierarchical", "truncated" or "gravity".')
+        if self.origin_subset and (self.OD_matrix_storage == 'memmap' or self.destination_sampler == 'gravity'):
+            raise ValueError('origin_subset can not be used with the memmap OD matrix storage '
+                             'or the gravity destination sampler.')
+        if self.destination_sampler == 'gravity':
+            centroids = read_MSOA_centroids(builder.data.load("internal_migration.path_to_MSOA_centroids"))
+            self.MSOA_neighbours = self.build_MSOA_neighbours(centroids, internal_migration_config.gravity_neighbours,
+                                                              internal_migration_config.gravity_radius)
+        if self.OD_matrix_precision not in OD_PRECISIONS:
+            raise ValueError(f'Unknown OD matrix precision {self.OD_matrix_precision}. '
+                             f'Use one of {list(OD_PRECISIONS)}.')
+        if self.destination_assignment not in ['individual', 'multinomial']:
+            raise ValueError(f'Unknown destination assignment {self.destination_assignment}. '
+                             f'Use one of "individual" or "multinomial".')
+
+        self.int_out_migration_rate = build_rate_table(builder, int_outmigration_data,
+                                                       internal_migration_config.rate_table)
 
         self.int_outmigration_rate = builder.value.register_rate_producer('int_outmigration_rate',
                                                                           source=self.calculate_outmigration_rate,
                                                                           requires_columns=['sex', 'location', 'ethnicity'])
 
-        self.list_OD_matrices, self.map_OD_file2index = self.read_OD_matrices_to_list()
+        self.clock = builder.time.clock()
+
+        self.MSOA_to_OD_row = self.MSOA_LAD_indices.drop_duplicates('MSOA11CD').set_index('MSOA11CD')['indices']
+        self.OD_origin_rows = np.array([], dtype=np.int64)
+        if self.yearly_OD_matrices:
+            self.OD_matrix_sets = YearlyODMatrices(self.get_OD_matrix_years(), self.read_OD_matrices_of_year)
+            self.OD_matrix_sets.swap(self.clock().year)
+            self.OD_samplers, self.map_OD_file2index = self.OD_matrix_sets.current
+        else:
+            self.OD_matrix_sets = None
+            self.OD_samplers, self.map_OD_file2index = self.read_OD_matrices_to_list()
+        # integer lookups so that keying migrants is a couple of vectorised takes
+        self.OD_MSOA_codes = pd.Index(self.MSOA_to_OD_row.index)
+        self.OD_MSOA_rows = self.MSOA_to_OD_row.to_numpy().astype(np.int64)
+        self.OD_matrix_lookup = build_OD_matrix_lookup(self.map_OD_file2index, self.OD_matrix_family)
 
         self.random = builder.randomness.get_stream('outmigtation_handler')
-        self.clock = builder.time.clock()
 
+        # history of the moves, the state table only holds the current location
+        self.migration_log = MigrationEventLog()
 
-        columns_created = ['internal_outmigration', 'last_outmigration_time', 'previous_LAD_locations', 'previous_MSOA_locations']
+        columns_created = ['internal_outmigration', 'last_outmigration_time']
         view_columns = columns_created + ['alive', 'age', 'sex', 'location', 'ethnicity', 'MSOA']
         self.population_view = builder.population.get_view(view_columns)
         builder.population.initializes_simulants(self.on_initialize_simulants,
-                                                 creates_columns=columns_created)
+                                                 creates_columns=columns_created,
+                                                 requires_columns=['MSOA'])
 
-        builder.event.register_listener('time_step', self.on_time_step, priority=0)
+        if not builder.components.get_components_by_type(CompetingRisks):
+            builder.event.register_listener('time_step', self.on_time_step, priority=0)
+        builder.event.register_listener('simulation_end', self.on_simulation_end)
 
     def on_initialize_simulants(self, pop_data):
         pop_update = pd.DataFrame({'internal_outmigration': 'No',
-                                   'last_outmigration_time': pd.NaT,
-                                   'previous_LAD_locations':[''],
-                                   'previous_MSOA_locations':['']},
+                                   'last_outmigration_time': pd.NaT},
                                    index=pop_data.index)
         self.population_view.update(pop_update)
 
+        if self.origin_subset:
+            self.add_OD_origins(self.population_view.subview(['MSOA']).get(pop_data.index)['MSOA'])
+
     def on_time_step(self, event):
+        self.swap_OD_matrices(self.clock().year)
+
         pop = self.population_view.get(event.index, query="alive =='alive' and sex != 'nan'")
         pop['time_since_last_migration'] = event.time - pop['last_outmigration_time']
 
@@ -72,25 +263,53 @@ class InternalMigration:
         prob_df = rate_to_probability(pd.DataFrame(self.int_outmigration_rate(pop.index)))
         prob_df['No'] = 1-prob_df.sum(axis=1)
         pop['internal_outmigration'] = self.random.choice(prob_df.index, prob_df.columns, prob_df)
-        int_outmigrated_pop = pop.query('internal_outmigration != "No"').copy()
+        int_outmigrated_pop = pop.query('internal_outmigration != "No"')
 
         if not int_outmigrated_pop.empty:
-            int_outmigrated_pop['internal_outmigration'] = pd.Series('Yes', index=int_outmigrated_pop.index)
-            int_outmigrated_pop['last_outmigration_time'] = event.time
-            int_outmigrated_pop['previous_LAD_locations'] += int_outmigrated_pop['location']
-            int_outmigrated_pop['previous_MSOA_locations'] += int_outmigrated_pop['MSOA']
+            self.apply_transitions(int_outmigrated_pop.copy(), int_outmigrated_pop['internal_outmigration'], event)
+
+    def transition_rates(self, pop, event):
+        """The internal out-migration rates of `pop`, competing with the other transitions.
+
+        The rate of the individuals that have migrated internally in the last year is 0.
+        """
+        self.swap_OD_matrices(self.clock().year)
 
-            new_MSOA, new_LAD = self.assign_internal_migration(int_outmigrated_pop)
+        rates = pd.DataFrame(self.int_outmigration_rate(pop.index))
+        migrated_last_year = (event.time - pop['last_outmigration_time']) <= pd.Timedelta("365 days")
+        rates.loc[migrated_last_year.to_numpy()] = 0.
+        return rates
 
-            int_outmigrated_pop['MSOA'] = new_MSOA
-            int_outmigrated_pop['location'] = new_LAD
+    def apply_transitions(self, int_outmigrated_pop, outcome, event):
+        """Moves `int_outmigrated_pop` to their new MSOA and LAD and records the moves."""
+        int_outmigrated_pop['internal_outmigration'] = pd.Series('Yes', index=int_outmigrated_pop.index)
+        int_outmigrated_pop['last_outmigration_time'] = event.time
 
-            self.population_view.update(int_outmigrated_pop[['last_outmigration_time', 
-                                                             'internal_outmigration', 
-                                                             'previous_LAD_locations',
-                                                             'previous_MSOA_locations',
-                                                             'MSOA',
-                                                             'location']])
+        new_MSOA, new_LAD = self.assign_internal_migration(int_outmigrated_pop)
+
+        self.migration_log.record(int_outmigrated_pop.index, event.time,
+                                  int_outmigrated_pop['MSOA'], new_MSOA,
+                                  int_outmigrated_pop['location'], new_LAD)
+
+        int_outmigrated_pop['MSOA'] = new_MSOA
+        int_outmigrated_pop['location'] = new_LAD
+
+        self.population_view.update(int_outmigrated_pop[['last_outmigration_time',
+                                                         'internal_outmigration',
+                                                         'MSOA',
+                                                         'location']])
+
+    def on_simulation_end(self, event):
+        if self.migration_log_path is not None:
+            self.migration_log.export(self.migration_log_path)
+        if self.OD_matrix_sets is not None:
+            self.OD_matrix_sets.close()
+
+    def swap_OD_matrices(self, year):
+        """Switches to the OD matrices in force in `year` when yearly OD matrices are used."""
+        if self.OD_matrix_sets is not None and self.OD_matrix_sets.swap(year):
+            self.OD_samplers, self.map_OD_file2index = self.OD_matrix_sets.current
+            self.OD_matrix_lookup = build_OD_matrix_lookup(self.map_OD_file2index, self.OD_matrix_family)
 
     def calculate_outmigration_rate(self, index):
         int_out_migration = self.int_out_migration_rate(index)
@@ -100,16 +319,16 @@ class InternalMigration:
         ''' Based on the characteristic individuals in the internal migration pool, get the relevant
          migration matrix  assign new locations and save the old ones in a new field
          '''
-        int_migration_matrix_rate = self.get_migration_matrix(int_migration_pool)
-
-        # Add a random seed for numpy
-        np.random.seed(64)
+        matrix_index, row_index = self.get_OD_matrix_rows(int_migration_pool)
 
-        # sample the rates for each individual and get the new wards.
-        c = int_migration_matrix_rate.cumsum(axis=1)
-        u = np.random.rand(len(c), 1)
-        # get the new MSA
-        MSOA_choices = (u < c).argmax(axis=1)
+        if self.destination_assignment == 'multinomial':
+            # draw the destination counts of each origin cell and share them out among its migrants
+            r = np.random.RandomState(seed=self.random.get_seed('destination_MSOA'))
+            MSOA_choices = sample_destination_counts(self.OD_samplers, matrix_index, row_index, r)
+        else:
+            # sample the new MSOA of each individual from the precomputed row distributions
+            u = self.random.get_draw(int_migration_pool.index, additional_key='destination_MSOA')
+            MSOA_choices = sample_destinations(self.OD_samplers, matrix_index, row_index, u.to_numpy())
 
         # from the MSOA index get the new MSOA and LAD location name
         MSOA_choices_name = list(map(self.internal_migration_MSOA_location_dict.get, MSOA_choices))
@@ -121,31 +340,151 @@ class InternalMigration:
         return (MSOA_choices_name,LAD_choices_name)
 
     def get_OD_matrix_age_gender(self, int_migration_pool):
-        # Age buckets based on the file names
-        cut_bins = [-1, 5, 16, 20, 25, 35, 50, 65, 75, 200]
-        cut_labels = ["0to4", "5to15", "16to19", "20to24", "25to34", "35to49", "50to64", "65to74", "75plus"]
-        int_migration_pool.loc[:, "age_bucket"] = pd.cut(int_migration_pool['age'], bins=cut_bins, labels=cut_labels)
-        # XXX recheck the sex_map
-        int_migration_pool.loc[:, "sex_map"] = int_migration_pool["sex"].map({1: 'M', 2: 'F'}) 
-
-        int_migration_pool["path2od_matrix"] = \
-            int_migration_pool["sex_map"].astype(str) + "_" + int_migration_pool["age_bucket"].astype(str) + "_" + "prob_matrix_EW.npz"
-        int_migration_pool.loc[:, "id2od_matrix"] = int_migration_pool["path2od_matrix"].replace(self.map_OD_file2index)
-        indexes = int_migration_pool["id2od_matrix"].to_numpy()
-        indexes = indexes.astype(np.int)
+        """Position of the OD matrix of each migrant, from their sex code and age bucket."""
+        sex = int_migration_pool['sex'].to_numpy().astype(np.int64)
+        age_bucket = OD_age_bucket_codes(int_migration_pool['age'].to_numpy())
+        indexes = self.OD_matrix_lookup[sex, age_bucket]
+        if (indexes < 0).any():
+            raise ValueError(f'No {self.OD_matrix_family} OD matrix in {self.path_to_OD_matrices} '
+                             f'for some of the migrants sex and age.')
         return indexes
 
-    def read_OD_matrices_to_list(self):
+    def get_OD_matrix_years(self):
+        """The years with a subdirectory of OD matrices in the OD matrices directory."""
+        years = [int(os.path.basename(path)) for path in glob.glob(os.path.join(self.path_to_OD_matrices, '*'))
+                 if os.path.isdir(path) and os.path.basename(path).isdigit()]
+        if not years:
+            raise ValueError(f'No <year> subdirectories of OD matrices in {self.path_to_OD_matrices}.')
+        return years
+
+    def read_OD_matrices_of_year(self, year):
+        """Reads the OD matrices of the <year> subdirectory, see `read_OD_matrices_to_list`."""
+        return self.read_OD_matrices_to_list(os.path.join(self.path_to_OD_matrices, str(year)))
+
+    def read_OD_matrices_to_list(self, path_to_OD_matrices=None):
+        """Reads the OD matrices and compiles each one into a destination sampler.
+
+        Parameters
+        ----------
+        path_to_OD_matrices : str, optional
+            Directory of the OD matrices, defaults to the one of the input data.
+
+        Returns
+        -------
+        (list of DestinationSampler, dict)
+            The samplers and the map from OD file name to position in the list.
+        """
+        path_to_OD_matrices = path_to_OD_matrices if path_to_OD_matrices is not None else self.path_to_OD_matrices
+        if self.OD_matrix_storage == 'memmap':
+            return self.read_OD_store(path_to_OD_matrices)
+
+        list_of_files = sorted(glob.glob(os.path.join(path_to_OD_matrices, f'*_{self.OD_matrix_family}_EW.npz')))
+        map_OD_file2index = {os.path.basename(file): i for i, file in enumerate(list_of_files)}
+
+        if self.lazy_OD_matrices:
+            return LazyODMatrices(list_of_files, self.read_OD_matrix, self.max_loaded_OD_matrices), map_OD_file2index
+        return [self.read_OD_matrix(file) for file in list_of_files], map_OD_file2index
+
+    def read_OD_matrix(self, file):
+        """Reads one OD matrix file into a destination sampler.
+
+        With origin_subset the sampler only builds the rows of the origins seen so far, and
+        builds further rows when migrants from other MSOAs need them.
+        """
+        if self.origin_subset:
+            with np.load(file) as od_npz:
+                n_origins = int(od_npz['shape'][0])
+            sampler = OriginSubsetSampler(partial(self.read_OD_matrix_rows, ODMatrixFile(file)), n_origins)
+            sampler.add_rows(self.OD_origin_rows)
+            return sampler
+        return self.to_sampler(scipy.sparse.load_npz(file))
+
+    def read_OD_matrix_rows(self, OD_file, rows):
+        """Builds the destination sampler of the given origin rows of an OD matrix file.
+
+        The file is read the first time rows are asked for and its CSR matrix is kept, so
+        later rows are sliced from it. The LAD -> MSOA stage of the hierarchical and truncated
+        samplers depends on the whole matrix, so it is built once and shared by later rows.
+        """
+        if self.destination_sampler != 'msoa':
+            sampler = self.to_destination_model(OD_file.matrix, rows, OD_file.second_stage)
+            OD_file.second_stage = second_stage(sampler)
+            return sampler
+        return self.to_sampler(OD_file.matrix[rows])
+
+    def to_sampler(self, OD_matrix):
+        """Builds the destination sampler of an OD matrix with the configured model and storage."""
+        if self.destination_sampler != 'msoa':
+            return self.to_destination_model(OD_matrix)
+        if self.OD_matrix_storage == 'sparse':
+            return DestinationSampler.from_matrix(OD_matrix).astype(self.OD_matrix_precision)
+        return DestinationSampler.from_matrix(OD_matrix.toarray()).astype(self.OD_matrix_precision)
+
+    def read_OD_store(self, path_to_OD_matrices):
+        """Memory-maps the compiled store of the OD matrix family, compiling it first if needed.
+
+        Pages of the store are only read from disk when a migrant's row is sampled, so the
+        store is already demand-driven and lazy_od_matrices has no effect on it.
+        """
+        path_to_store = os.path.join(path_to_OD_matrices, OD_STORE_FILE.format(family=self.OD_matrix_family))
+        if not os.path.exists(path_to_store):
+            compile_OD_store(path_to_OD_matrices, self.OD_matrix_family, self.OD_matrix_precision)
+
+        samplers, _ = read_OD_store(path_to_store)
+        names = sorted(samplers)
+        stored_precisions = {sampler.precision for sampler in samplers.values()}
+        if stored_precisions - {self.OD_matrix_precision}:
+            raise ValueError(f'The OD store {path_to_store} holds {sorted(stored_precisions)} CDFs, '
+                             f'remove it or recompile it with precision {self.OD_matrix_precision}.')
+        if self.destination_sampler != 'msoa':
+            samplers = {name: self.to_destination_model(sampler.probabilities(np.arange(sampler.n_origins)))
+                        for name, sampler in samplers.items()}
+        return [samplers[name] for name in names], {name: i for i, name in enumerate(names)}
+
+    def build_MSOA_neighbours(self, centroids, k, radius):
+        """Finds the gravity model candidates of each OD matrix column from the MSOA centroids."""
+        column_MSOA = pd.Series(self.internal_migration_MSOA_location_dict).sort_index()
+        column_LAD = pd.Series(self.internal_migration_LAD_location_dict).reindex(column_MSOA.index)
+        MSOA_LAD = pd.Series(column_LAD.to_numpy(), index=column_MSOA.to_numpy())
+        return MSOANeighbours.from_centroids(fill_MSOA_centroids(centroids, MSOA_LAD), k, radius)
+
+    def to_destination_model(self, OD_matrix, rows=None, MSOA_sampler=None):
+        """Builds the sampler of the configured destination model from an OD matrix.
+
+        MSOAs are grouped into LADs with the LAD index. The LAD level tables are always sparse,
+        whatever the OD matrix storage. With `rows`, only the sampler of those origin rows is
+        built, reusing the LAD -> MSOA stage `MSOA_sampler` if it was built before.
+        """
+        if self.destination_sampler == 'gravity':
+            return GravityDestinationSampler.from_matrix(OD_matrix, self.MSOA_neighbours)
+        column_LAD = pd.Series(self.internal_migration_LAD_location_dict)
+        if self.destination_sampler == 'truncated':
+            sampler = TruncatedDestinationSampler.from_matrix(OD_matrix, column_LAD, self.top_k_destinations,
+                                                              rows, MSOA_sampler)
+        else:
+            sampler = HierarchicalDestinationSampler.from_matrix(OD_matrix, column_LAD, rows, MSOA_sampler)
+        return sampler.astype(self.OD_matrix_precision)
+
+    def add_OD_origins(self, MSOAs):
+        """Adds the OD rows of the given MSOAs to the origin subset of the samplers held."""
+        rows = self.MSOA_to_OD_row.reindex(pd.unique(MSOAs)).dropna().to_numpy().astype(np.int64)
+        self.OD_origin_rows = np.union1d(self.OD_origin_rows, rows)
+        if isinstance(self.OD_samplers, LazyODMatrices):
+            held = self.OD_samplers.loaded
+        else:
+            held = range(len(self.OD_samplers))
+        for i in held:
+            self.OD_samplers[i].add_rows(rows)
+
+    def get_OD_matrix_rows(self, int_migration_pool):
+        """Finds the OD matrix and the origin row of each migrant, based on their sex, age and MSOA."""
+        MSOA_position = self.OD_MSOA_codes.get_indexer(int_migration_pool['MSOA'])
+        if (MSOA_position < 0).any():
+            unknown = int_migration_pool['MSOA'][MSOA_position < 0].unique()
+            raise ValueError(f'MSOAs {list(unknown)} do not have a row in the OD matrices.')
 
-        list_of_files = glob.glob(os.path.join(self.path_to_OD_matrices, '*.npz'))
-
-        list_of_OD_matrices = []
-        map_OD_file2index = {}
-        for i, file in enumerate(list_of_files):
-            map_OD_file2index[os.path.basename(file)] = i
-            od_npz = scipy.sparse.load_npz(file)
-            list_of_OD_matrices.append(od_npz.A)
-        return np.array(list_of_OD_matrices), map_OD_file2index
+        matrix_index = self.get_OD_matrix_age_gender(int_migration_pool)
+        return matrix_index, self.OD_MSOA_rows.take(MSOA_position)
 
     def get_migration_matrix(self,int_migration_pool):
         '''
@@ -154,24 +493,12 @@ class InternalMigration:
         2. This results in a matrix of n x m where (n is the number of migrants in the pool, m is the number of potential MSOA they can be assign to).
         3. Normalise the matrix by total number of counts in each row, to obtain rates
         4. Return the rate  matrix of n x m
-        '''
-        sel_rows = self.MSOA_LAD_indices.merge(int_migration_pool, 
-                                              left_on="MSOA11CD",
-                                              right_on=["MSOA"])
-
-        #int_migration_matrix = self.OD_matrix[sel_rows.indices.to_list()]
-
-        matrix_index = self.get_OD_matrix_age_gender(int_migration_pool)
-        int_migration_matrix = self.list_OD_matrices[matrix_index, sel_rows.indices.to_list()]
 
-        # Normalise the matrix to get rates
-        #int_migration_matrix_rate = int_migration_matrix[:, 1:] / int_migration_matrix[:, 1:].sum(axis=1)[:, None]
-
-        int_migration_matrix += 1e-10
-        row_sum = int_migration_matrix.sum(axis=1)
-        int_migration_matrix_rate = int_migration_matrix / row_sum[:, None]
-
-        return int_migration_matrix_rate
+        The rates are recovered from the precomputed destination samplers. With sparse OD matrices
+        the rate matrix is returned as CSR, rows without flows are left empty instead of smoothed.
+        '''
+        matrix_index, row_index = self.get_OD_matrix_rows(int_migration_pool)
+        return gather_probabilities(self.OD_samplers, matrix_index, row_index)
 
     def __repr__(self):
         return "InternalMigration()"
@@ -10,17 +10,37 @@ import pandas as pd
 
 from vivarium.framework.utilities import rate_to_probability
 
+from vivarium_population_spenser.population.competing_risks import CompetingRisks
+from vivarium_population_spenser.population.event_scheduling import SCHEDULING_MODES, NextEventScheduler
+from vivarium_population_spenser.population.rate_cubes import build_rate_table
+
 
 class Mortality:
 
+    # columns the competing risks engine reads for this component
+    transition_columns = ['age']
+
+    configuration_defaults = {
+        'mortality': {
+            # 'lookup' interpolates the rates with a vivarium lookup table and 'cube' compiles them into
+            # a dense array indexed by sex, LAD, ethnicity, integer age and year. 'cells' interpolates
+            # them once per sex, LAD, ethnicity and integer age and broadcasts them to the simulants
+            'rate_table': 'lookup',
+            # 'step' draws whether each living simulant transitions in every time step, 'next_event'
+            # draws the time of the transition of each simulant whenever their rates change and
+            # only handles the transitions due in each time step
+            'scheduling': 'step',
+        }
+    }
+
     @property
     def name(self):
         return 'mortality'
 
     def setup(self, builder):
         all_cause_mortality_data = builder.data.load("cause.all_causes.cause_specific_mortality_rate")
-        self.all_cause_mortality_rate = builder.lookup.build_table(all_cause_mortality_data, key_columns=['sex','location','ethnicity'],
-                                                                   parameter_columns=['age', 'year'])
+        self.all_cause_mortality_rate = build_rate_table(builder, all_cause_mortality_data,
+                                                         builder.configuration.mortality.rate_table)
 
 
         self.mortality_rate = builder.value.register_rate_producer('mortality_rate',
@@ -39,7 +59,19 @@ class Mortality:
         builder.population.initializes_simulants(self.on_initialize_simulants,
                                                  creates_columns=columns_created)
 
-        builder.event.register_listener('time_step', self.on_time_step, priority=0)
+        self.scheduling = builder.configuration.mortality.scheduling
+        if self.scheduling not in SCHEDULING_MODES:
+            raise ValueError(f'Unknown scheduling {self.scheduling}. Use one of {SCHEDULING_MODES}.')
+        competing_risks = builder.components.get_components_by_type(CompetingRisks)
+        if competing_risks and self.scheduling == 'next_event':
+            raise ValueError('The next_event scheduling can not be used with the competing risks component.')
+        self.scheduler = None
+        if self.scheduling == 'next_event':
+            self.scheduler = NextEventScheduler(self.population_view.subview(['alive', 'sex', 'age', 'location']),
+                                                self.mortality_rate, self.random, self.clock)
+
+        if not competing_risks:
+            builder.event.register_listener('time_step', self.on_time_step, priority=0)
 
     def on_initialize_simulants(self, pop_data):
         pop_update = pd.DataFrame({'cause_of_death': 'not_dead',
@@ -47,18 +79,36 @@ class Mortality:
                                   index=pop_data.index)
         self.population_view.update(pop_update)
 
+        if self.scheduler is not None:
+            self.scheduler.add_simulants(pop_data.index)
+
     def on_time_step(self, event):
+        if self.scheduler is not None:
+            outcome = self.scheduler.due_transitions(event)
+            if not outcome.empty:
+                self.apply_transitions(self.population_view.get(outcome.index), outcome, event)
+            return
+
         pop = self.population_view.get(event.index, query="alive =='alive' and sex != 'nan'")
         prob_df = rate_to_probability(pd.DataFrame(self.mortality_rate(pop.index)))
         prob_df['no_death'] = 1-prob_df.sum(axis=1)
         prob_df['cause_of_death'] = self.random.choice(prob_df.index, prob_df.columns, prob_df)
-        dead_pop = prob_df.query('cause_of_death != "no_death"').copy()
+        dead_pop = prob_df.query('cause_of_death != "no_death"')
 
         if not dead_pop.empty:
-            dead_pop['alive'] = pd.Series('dead', index=dead_pop.index)
-            dead_pop['exit_time'] = event.time
-            dead_pop['years_of_life_lost'] = self.life_expectancy(dead_pop.index) -  pop.loc[dead_pop.index]['age']
-            self.population_view.update(dead_pop[['alive', 'exit_time', 'cause_of_death', 'years_of_life_lost']])
+            self.apply_transitions(pop.loc[dead_pop.index].copy(), dead_pop['cause_of_death'], event)
+
+    def transition_rates(self, pop, event):
+        """The mortality rates of `pop`, competing with the other transitions."""
+        return pd.DataFrame(self.mortality_rate(pop.index))
+
+    def apply_transitions(self, dead_pop, cause_of_death, event):
+        """Records the deaths of `dead_pop` at `event.time`."""
+        dead_pop['alive'] = pd.Series('dead', index=dead_pop.index)
+        dead_pop['exit_time'] = event.time
+        dead_pop['cause_of_death'] = cause_of_death
+        dead_pop['years_of_life_lost'] = self.life_expectancy(dead_pop.index) - dead_pop['age']
+        self.population_view.update(dead_pop[['alive', 'exit_time', 'cause_of_death', 'years_of_life_lost']])
 
     def calculate_mortality_rate(self, index):
         mortality_rate = self.all_cause_mortality_rate(index)
@@ -0,0 +1,224 @@
+"""
+==========
+Rate Cubes
+==========
+
+This module contains a dense store of the rate tables of the package. A rate table, one
+row per sex, LAD, ethnicity, age bin and year bin, is compiled into an ndarray indexed by
+the integer codes of the sex, LAD and ethnicity and by the integer age and year, so the
+rate of each simulant is a single gather instead of an interpolation table query.
+
+It also contains a table that interpolates the rates once per demographic cell (sex, LAD,
+ethnicity and integer age) rather than once per simulant, and broadcasts them to the
+simulants of each cell.
+
+"""
+import numpy as np
+import pandas as pd
+from vivarium.interpolation import Interpolation
+
+RATE_KEY_COLUMNS = ['sex', 'location', 'ethnicity']
+RATE_TABLES = ['lookup', 'cube', 'cells']
+
+
+def integer_bins(start, end):
+    """The first integer ``k`` with ``start <= k < end`` of each bin and the number of them."""
+    first = np.ceil(np.asarray(start, dtype=float)).astype(np.int64)
+    lengths = np.maximum(np.ceil(np.asarray(end, dtype=float)).astype(np.int64) - first, 0)
+    return first, lengths
+
+
+def repeat_segments(lengths):
+    """The segment of each of ``sum(lengths)`` elements, and its position within the segment."""
+    segments = np.repeat(np.arange(len(lengths)), lengths)
+    return segments, np.arange(len(segments)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+class RateCube:
+    """The rates of a rate table held in a dense sex x LAD x ethnicity x age x year array.
+
+    Ages and years are single-year bins: the rate of age ``a`` and year ``y`` is the one of
+    the table row whose bins hold ``a`` and ``y``. Ages and years beyond those of the table
+    take the rate of the nearest one, as the lookup tables extrapolate. The table must hold
+    every combination of its sexes, LADs and ethnicities over the same ages and years.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The rates, of shape (sexes, LADs, ethnicities, ages, years).
+    keys : list of pandas.Index
+        The sex, LAD and ethnicity of each code of the first three axes.
+    age_start : int
+        The age of the first age code.
+    year_start : int
+        The year of the first year code.
+    """
+
+    def __init__(self, values, keys, age_start, year_start):
+        self.values = values
+        self.keys = keys
+        self.age_start = age_start
+        self.year_start = year_start
+
+    @classmethod
+    def from_table(cls, table, value_column='mean_value'):
+        """Compiles a rate table with sex, location, ethnicity, age and year bins into a cube.
+
+        Raises
+        ------
+        ValueError
+            If a combination of the sexes, LADs and ethnicities of the table is missing, or
+            misses some of the ages and years of the others.
+        """
+        keys = [pd.Index(np.unique(table[column])) for column in RATE_KEY_COLUMNS]
+        first_age, n_ages = integer_bins(table['age_start'], table['age_end'])
+        first_year, n_years = integer_bins(table['year_start'], table['year_end'])
+        if not (n_ages * n_years).any():
+            raise ValueError('The rate table has no age and year bins holding an integer.')
+
+        # every (integer age, integer year) cell of each row
+        row, position = repeat_segments(n_ages * n_years)
+        ages = first_age[row] + position // n_years[row]
+        years = first_year[row] + position % n_years[row]
+        age_start, year_start = ages.min(), years.min()
+
+        shape = [len(key) for key in keys] + [ages.max() - age_start + 1, years.max() - year_start + 1]
+        values, filled = np.zeros(shape), np.zeros(shape, dtype=bool)
+        key_codes = [key.get_indexer(table[column].to_numpy()[row]) for key, column in zip(keys, RATE_KEY_COLUMNS)]
+        cells = tuple(key_codes) + (ages - age_start, years - year_start)
+        values[cells] = table[value_column].to_numpy()[row]
+        filled[cells] = True
+
+        if not filled.all():
+            key_filled = filled.any(axis=(3, 4))
+            if not key_filled.all():
+                missing = [tuple(key[code] for key, code in zip(keys, codes)) for codes in np.argwhere(~key_filled)]
+                raise ValueError(f'The rate table has no rates for the {RATE_KEY_COLUMNS} {missing[:10]}.')
+            sex, location, ethnicity, age, year = np.argwhere(~filled)[0]
+            raise ValueError(f'The rate table has no rate for {keys[0][sex]}, {keys[1][location]}, '
+                             f'{keys[2][ethnicity]} at age {age + age_start} in {year + year_start}, '
+                             f'its ages and years have gaps.')
+        return cls(values, keys, int(age_start), int(year_start))
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def key_codes(self, sex, location, ethnicity):
+        """The codes of the sex, LAD and ethnicity of each simulant."""
+        codes = []
+        for key, column, value in zip(self.keys, RATE_KEY_COLUMNS, [sex, location, ethnicity]):
+            code = key.get_indexer(np.asarray(value))
+            if (code < 0).any():
+                missing = pd.unique(np.asarray(value)[code < 0])
+                raise ValueError(f'No rates for {column} {list(missing)}.')
+            codes.append(code)
+        return codes
+
+    def age_codes(self, age):
+        return np.clip(np.floor(np.asarray(age, dtype=float)).astype(np.int64) - self.age_start,
+                       0, self.values.shape[3] - 1)
+
+    def year_code(self, year):
+        return int(np.clip(int(year) - self.year_start, 0, self.values.shape[4] - 1))
+
+    def rates(self, sex, location, ethnicity, age, year):
+        """The rate of each simulant, from their sex, LAD, ethnicity and age, in `year`."""
+        sex_code, location_code, ethnicity_code = self.key_codes(sex, location, ethnicity)
+        return self.values[sex_code, location_code, ethnicity_code, self.age_codes(age), self.year_code(year)]
+
+
+class RateCubeTable:
+    """A rate cube used in place of a lookup table: called with an index, it returns the rates of those simulants."""
+
+    def __init__(self, cube, population_view, clock):
+        self.cube = cube
+        self.population_view = population_view
+        self.clock = clock
+
+    def __call__(self, index):
+        pop = self.population_view.get(index)
+        rates = self.cube.rates(pop['sex'], pop['location'], pop['ethnicity'], pop['age'], self.clock().year)
+        return pd.Series(rates, index=index)
+
+
+class CellRateTable:
+    """Interpolates the rates once per demographic cell and broadcasts them to the simulants.
+
+    Simulants of the same sex, LAD, ethnicity and integer age share their rate, so the rates
+    of the cells seen in the current year are kept and only the cells not seen yet, such as
+    the ones simulants enter on their birthday, are interpolated. The kept rates are dropped
+    when the year changes. The rates are assumed to change only at integer ages and years.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The rate table, with sex, location, ethnicity, age and year bins and a mean_value.
+    population_view : vivarium.framework.population.PopulationView
+        A view on the sex, location, ethnicity and age of the simulants.
+    clock : callable
+        The simulation clock.
+    """
+
+    def __init__(self, data, population_view, clock, value_column='mean_value'):
+        parameter_columns = [('age', 'age_start', 'age_end'), ('year', 'year_start', 'year_end')]
+        table_columns = RATE_KEY_COLUMNS + [column for p in parameter_columns for column in p[1:]] + [value_column]
+        self.interpolation = Interpolation(data[table_columns], RATE_KEY_COLUMNS, parameter_columns,
+                                           order=0, extrapolate=True)
+        self.value_column = value_column
+        self.population_view = population_view
+        self.clock = clock
+        self.year = None
+        self.cell_rates = None
+
+    def __call__(self, index):
+        return self.rates(self.population_view.get(index), self.clock().year)
+
+    def rates(self, pop, year):
+        """The rate of each simulant of `pop` in `year`, from the rates of their cells."""
+        if year != self.year:
+            self.year = year
+            self.cell_rates = None
+        if pop.empty:
+            return pd.Series(np.zeros(0), index=pop.index)
+
+        cells = pd.MultiIndex.from_arrays([pop['sex'], pop['location'], pop['ethnicity'], np.floor(pop['age'])])
+        codes, unique_cells = cells.factorize()
+
+        new_cells = unique_cells if self.cell_rates is None else unique_cells.difference(self.cell_rates.index)
+        if len(new_cells):
+            interpolants = new_cells.to_frame(index=False, name=RATE_KEY_COLUMNS + ['age'])
+            interpolants['year'] = float(year)
+            new_rates = pd.Series(self.interpolation(interpolants)[self.value_column].to_numpy(), index=new_cells)
+            self.cell_rates = new_rates if self.cell_rates is None else pd.concat([self.cell_rates, new_rates])
+
+        return pd.Series(self.cell_rates.reindex(unique_cells).to_numpy()[codes], index=pop.index)
+
+
+def build_rate_table(builder, data, rate_table):
+    """Builds the table of rates of the simulants from a rate table.
+
+    Parameters
+    ----------
+    builder : vivarium.engine.Builder
+        Framework coordination object.
+    data : pandas.DataFrame
+        The rate table, with sex, location, ethnicity, age and year bins and a mean_value.
+    rate_table : str
+        'lookup' builds a vivarium lookup table, 'cube' compiles a `RateCube` and 'cells'
+        builds a `CellRateTable`.
+
+    Returns
+    -------
+    callable
+        Called with an index, returns the rates of those simulants.
+    """
+    if rate_table == 'lookup':
+        return builder.lookup.build_table(data, key_columns=RATE_KEY_COLUMNS, parameter_columns=['age', 'year'])
+    if rate_table == 'cube':
+        population_view = builder.population.get_view(RATE_KEY_COLUMNS + ['age', 'tracked'])
+        return RateCubeTable(RateCube.from_table(data), population_view, builder.time.clock())
+    if rate_table == 'cells':
+        population_view = builder.population.get_view(RATE_KEY_COLUMNS + ['age', 'tracked'])
+        return CellRateTable(data, population_view, builder.time.clock())
+    raise ValueError(f'Unknown rate table {rate_table}. Use one of {RATE_TABLES}.')
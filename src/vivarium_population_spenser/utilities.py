@@ -9,12 +9,8 @@ vivarium_population_spenser components.
 """
 from typing import Union
 
-import glob
 import numpy as np
-import os
 import pandas as pd
-from scipy.sparse import coo_matrix
-import scipy
 import yaml
 
 def read_config_file(filename=r'../config/model_specification.yaml'):
@@ -23,26 +19,6 @@ def read_config_file(filename=r'../config/model_specification.yaml'):
         inp_file = yaml.load(inp_file_io, Loader=yaml.FullLoader)
     return inp_file
 
-def csv2sparse(path2csv="../persistant_data/od_matrices/*.csv"):
-
-    list_of_files = glob.glob(path2csv)
-    
-    for i, fi in enumerate(list_of_files):
-        print(f"Processing: {fi}")
-        od = pd.read_csv(fi).values
-
-        if i == 0:
-            od_map = {}
-            for i, item in enumerate(od[:, 0]):
-                od_map[item] = i
-            od_map_pd = pd.DataFrame.from_dict(od_map, orient="index", columns=["indices"]) 
-            od_map_pd.to_csv(os.path.join(os.path.dirname(fi), os.pardir, "MSOA_to_OD_index.csv"))
-        
-        od_val = od[:, 1:]
-        od_val = od_val.astype(np.float)
-        od_val_sparse = coo_matrix(od_val)
-        scipy.sparse.save_npz(fi.split(".csv")[0] + ".npz", od_val_sparse)
-
 class EntityString(str):
     """Convenience class for representing entities as strings."""
 
@@ -93,6 +69,51 @@ class TargetString(str):
         return split[0], split[1], split[2]
 
 
+class AliasSampler:
+    """Walker's alias table over a discrete distribution.
+
+    The table is built once in O(k) for k outcomes, after which every draw is a constant time
+    lookup: one uniform draw picks a column and the rest of it decides between the column and
+    its alias.
+
+    Parameters
+    ----------
+    weights : array_like
+        Non negative, unnormalised weight of each outcome.
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        if not len(weights) or not np.isfinite(weights).all() or (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError('The weights of an alias table must be finite, non negative and not all zero.')
+
+        n = len(weights)
+        scaled = weights * n / weights.sum()
+        self.probability = np.ones(n)
+        self.alias = np.arange(n)
+        small = list(np.flatnonzero(scaled < 1))
+        large = list(np.flatnonzero(scaled >= 1))
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # whatever is left is within rounding of one and keeps its own column
+
+    def sample(self, u):
+        """Draws one outcome per uniform draw over [0, 1).
+
+        Returns
+        -------
+        numpy.ndarray
+            The position of each outcome in the weights.
+        """
+        scaled = np.asarray(u, dtype=float) * len(self.alias)
+        column = np.minimum(scaled.astype(np.int64), len(self.alias) - 1)
+        return np.where(scaled - column < self.probability[column], column, self.alias[column])
+
+
 DAYS_PER_YEAR = 365.25
 DAYS_PER_MONTH = DAYS_PER_YEAR / 12
 
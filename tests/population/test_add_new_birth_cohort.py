@@ -1,4 +1,5 @@
 from pathlib import Path
+from types import SimpleNamespace
 
 import numpy as np
 import pandas as pd
@@ -8,6 +9,7 @@ from vivarium_population_spenser.population.spenser_population import TestPopula
 
 from vivarium_population_spenser import utilities
 from vivarium_population_spenser.population import FertilityAgeSpecificRates
+from vivarium_population_spenser.population.add_new_birth_cohorts import PREGNANCY_DURATION, fertility_window
 
 
 @pytest.fixture()
@@ -85,3 +87,67 @@ def test_fertility_module(config, base_plugins):
     for i in range(start_population_size, len(pop)):
         assert pop.loc[pop.iloc[i].parent_id].last_birth_time >= time_start, 'expect all children to have mothers who' \
                                                                              ' gave birth after the simulation starts.'
+
+
+def test_fertility_window():
+    time = pd.Timestamp('2011-01-01')
+    age = pd.Series([5., 20., 30., 60.], index=[3, 4, 5, 6])
+    last_birth_time = pd.Series([pd.NaT, pd.NaT, time - pd.Timedelta(days=30), pd.NaT], index=age.index)
+
+    window = fertility_window(age, last_birth_time, time, (10., 50.))
+
+    assert window.loc[3, 'eligible_from'] == time + pd.Timedelta(days=5 * utilities.DAYS_PER_YEAR)
+    assert window.loc[4, 'eligible_from'] <= time
+    assert window.loc[5, 'eligible_from'] == time - pd.Timedelta(days=30) + PREGNANCY_DURATION
+    assert window.loc[5, 'eligible_until'] == time + pd.Timedelta(days=20 * utilities.DAYS_PER_YEAR)
+    assert window.loc[6, 'eligible_until'] < time
+
+
+class PopulationView:
+
+    def __init__(self, state):
+        self.state = state
+
+    def subview(self, columns):
+        return self
+
+    def get(self, index):
+        return self.state.loc[index]
+
+    def update(self, pop):
+        for column in pop.columns:
+            self.state.loc[pop.index, column] = pop[column]
+
+
+class Randomness:
+
+    def choice(self, index, choices, additional_key=None):
+        return pd.Series(choices[0], index=index)
+
+
+def test_newborns_inherit_mother_attributes():
+    # the newborns 2 and 3 are appended to the state table with their attributes unset
+    state = pd.DataFrame({'sex': [2., 2., np.nan, np.nan], 'age': [30., 25., np.nan, np.nan],
+                          'location': ['E08000032', 'E08000033', np.nan, np.nan],
+                          'ethnicity': ['WBI', 'PAK', np.nan, np.nan],
+                          'MSOA': ['E02002183', 'E02002200', np.nan, np.nan],
+                          'last_birth_time': pd.NaT, 'parent_id': [-1, -1, np.nan, np.nan]})
+    fertility = FertilityAgeSpecificRates()
+    fertility.population_view = PopulationView(state)
+    fertility.randomness = Randomness()
+    fertility.fertile_ages = None
+    fertility.unknown_sex = pd.Index([])
+
+    # the mothers are passed in reverse order, so the attributes must follow the parents and not the index
+    parents = state.loc[[1, 0], ['location', 'ethnicity', 'MSOA']]
+    pop_data = SimpleNamespace(index=pd.Index([2, 3]), creation_time=pd.Timestamp('2011-01-01'),
+                               user_data={'sim_state': 'time_step', 'parent_ids': [1, 0],
+                                          'parent_attributes': parents})
+    fertility.on_initialize_simulants(pop_data)
+
+    newborns = state.loc[[2, 3]]
+    assert newborns['location'].tolist() == ['E08000033', 'E08000032']
+    assert newborns['ethnicity'].tolist() == ['PAK', 'WBI']
+    assert newborns['MSOA'].tolist() == ['E02002200', 'E02002183']
+    assert newborns['parent_id'].tolist() == [1, 0]
+    assert newborns['age'].tolist() == [0., 0.] and newborns['sex'].tolist() == [1., 1.]
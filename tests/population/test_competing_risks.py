@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+
+from vivarium_population_spenser.population.competing_risks import NO_TRANSITION, competing_risks_probabilities
+
+
+def test_competing_risks_probabilities():
+    rates = pd.DataFrame({'all_causes': [0.1, 0., 2.], 'emigrated': [0.3, 0., 0.]}, index=[4, 5, 6])
+
+    probabilities = competing_risks_probabilities(rates)
+
+    assert list(probabilities.columns) == ['all_causes', 'emigrated', NO_TRANSITION]
+    assert np.allclose(probabilities.sum(axis=1), 1.)
+    assert np.allclose(probabilities[NO_TRANSITION], np.exp(-np.array([0.4, 0., 2.])))
+    assert np.isclose(probabilities.loc[4, 'emigrated'], 3 * probabilities.loc[4, 'all_causes'])
+    assert np.allclose(probabilities.loc[5, ['all_causes', 'emigrated']], 0.)
+    assert probabilities.loc[6, 'emigrated'] == 0.
@@ -0,0 +1,128 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from vivarium_population_spenser import utilities
+from vivarium_population_spenser.population.event_scheduling import (NANOSECONDS_PER_YEAR, EventQueue,
+                                                                       NextEventScheduler, hazard_change_times)
+
+
+def to_nanoseconds(dates):
+    return pd.to_datetime(dates).to_numpy().astype('datetime64[ns]').astype(np.int64)
+
+
+def test_hazard_change_times():
+    time = pd.Timestamp('2011-07-01').value
+    change = hazard_change_times(np.array([30.75, 30.25, 4.]), np.full(3, time))
+
+    # a quarter of a year to the birthday, the start of the year comes first, a whole year to the birthday
+    assert change[0] == time + NANOSECONDS_PER_YEAR // 4
+    assert change[1] == pd.Timestamp('2012-01-01').value
+    assert change[2] == pd.Timestamp('2012-01-01').value
+    time = pd.Timestamp('2011-01-01').value
+    assert abs(hazard_change_times(np.array([4.9]), np.array([time]))[0] - (time + NANOSECONDS_PER_YEAR / 10)) < 1000
+
+
+def test_EventQueue():
+    queue = EventQueue()
+    times = to_nanoseconds(['2011-03-01', '2011-01-15', '2011-02-01', '2011-05-01'])
+    queue.schedule(np.array([0, 1, 2, 3]), times, np.array([True, False, True, True]))
+    # a new event supersedes the pending one
+    queue.schedule(np.array([3]), to_nanoseconds(['2011-01-20']), np.array([False]))
+
+    simulants, due_times, is_transition = queue.pop_due(pd.Timestamp('2011-02-01'))
+
+    assert np.array_equal(simulants, [1, 3, 2])
+    assert np.array_equal(due_times, to_nanoseconds(['2011-01-15', '2011-01-20', '2011-02-01']))
+    assert np.array_equal(is_transition, [False, False, True])
+    assert len(queue) == 1
+    assert len(queue.pop_due(pd.Timestamp('2011-02-28'))[0]) == 0
+    assert np.array_equal(queue.pop_due(pd.Timestamp('2012-01-01'))[0], [0])
+
+
+class PopulationView:
+
+    def __init__(self, state):
+        self.state = state
+
+    def get(self, index, query=''):
+        return self.state.loc[index].query(query)
+
+
+class Randomness:
+
+    def __init__(self, seed):
+        self.random_state = np.random.RandomState(seed)
+
+    def get_draw(self, index, additional_key=None):
+        return pd.Series(self.random_state.random_sample(len(index)), index=index)
+
+
+def simulate_deaths(scheduling, age, location_rates, moves=None, steps=36, seed=12345):
+    """Deaths over `steps` steps of 10 days of simulants of `age`, whose yearly mortality is 10 times higher from 50.
+
+    The rates of each location are scaled by `location_rates` and the simulants of `moves`, a
+    step -> index mapping, move from location 'A' to 'B' at the end of that step.
+    """
+    r = np.random.RandomState(seed)
+    state = pd.DataFrame({'alive': 'alive', 'sex': 1., 'age': age, 'location': 'A'})
+    step_size = pd.Timedelta(days=10)
+    time = [pd.Timestamp('2011-01-01')]
+
+    def rate(index):
+        yearly_rate = (np.where(state.loc[index, 'age'] >= 50, 0.2, 0.02)
+                       * state.loc[index, 'location'].map(location_rates).to_numpy())
+        return pd.DataFrame({'death': yearly_rate * utilities.to_years(step_size)}, index=index)
+
+    scheduler = NextEventScheduler(PopulationView(state), rate, Randomness(seed + 1), lambda: time[0])
+    scheduler.add_simulants(state.index)
+    for step in range(steps):
+        if scheduling == 'next_event':
+            event = SimpleNamespace(index=state.index, time=time[0] + step_size, step_size=step_size)
+            dead = scheduler.due_transitions(event).index
+        else:
+            alive = state.index[state.alive == 'alive']
+            dead = alive[r.random_sample(len(alive)) < 1 - np.exp(-rate(alive)['death'])]
+        state.loc[dead, 'alive'] = 'dead'
+        if moves is not None and step in moves:
+            state.loc[moves[step], 'location'] = 'B'
+        state.loc[state.alive == 'alive', 'age'] += utilities.to_years(step_size)
+        time[0] += step_size
+    return (state.alive == 'dead').sum()
+
+
+def assert_expected_deaths(deaths, hazard):
+    """`deaths` is within 4 standard deviations of the number expected from the cumulative hazard of each simulant."""
+    p = 1 - np.exp(-hazard)
+    assert abs(deaths - p.sum()) < 4 * np.sqrt(np.sum(p * (1 - p)))
+
+
+def test_NextEventScheduler_expected_deaths():
+    # simulants turn 50 within the year and their mortality rises tenfold on their birthday
+    age = 49. + np.random.RandomState(0).random_sample(100000)
+    step = utilities.to_years(pd.Timedelta(days=10))
+    years_to_birthday = 50. - age
+
+    # the next events follow the rates from the birthday on
+    hazard = 0.02 * np.minimum(years_to_birthday, 36 * step) + 0.2 * np.maximum(36 * step - years_to_birthday, 0.)
+    assert_expected_deaths(simulate_deaths('next_event', age, {'A': 1.}), hazard)
+
+    # each step takes the rates at its start
+    steps_before_birthday = np.minimum(np.ceil(years_to_birthday / step), 36)
+    hazard = 0.02 * steps_before_birthday * step + 0.2 * (36 - steps_before_birthday) * step
+    assert_expected_deaths(simulate_deaths('step', age, {'A': 1.}), hazard)
+
+
+def test_NextEventScheduler_moves():
+    # half of the simulants move after 12 steps to a location with a mortality 10 times higher,
+    # no birthday nor new year falls within the 36 steps
+    age = np.full(100000, 30.)
+    step = utilities.to_years(pd.Timedelta(days=10))
+    movers = pd.RangeIndex(50000)
+
+    deaths = simulate_deaths('next_event', age, {'A': 2.5, 'B': 25.}, moves={11: movers})
+
+    hazard = np.full(len(age), 0.05 * 36 * step)
+    hazard[movers] = 0.05 * 12 * step + 0.5 * 24 * step
+    assert_expected_deaths(deaths, hazard)
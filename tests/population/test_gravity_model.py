@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+from vivarium_population_spenser.population import gravity_model
+
+
+def make_centroids():
+    # five MSOAs on a line, 1 km apart
+    return np.column_stack([np.arange(5) * 1000., np.zeros(5)])
+
+
+def test_MSOANeighbours():
+    nearest = gravity_model.MSOANeighbours.from_centroids(make_centroids(), k=2)
+    within = gravity_model.MSOANeighbours.from_centroids(make_centroids(), radius=1.5)
+
+    assert np.array_equal(np.diff(nearest.indptr), [2, 2, 2, 2, 2])
+    assert np.array_equal(nearest.indices[:2], [0, 1]) and np.allclose(nearest.distances[:2], [0., 1.])
+    assert np.array_equal(np.diff(within.indptr), [2, 3, 3, 3, 2])
+    assert np.array_equal(within.indices[2:5], [0, 1, 2])
+
+
+def test_GravityDestinationSampler():
+    neighbours = gravity_model.MSOANeighbours.from_centroids(make_centroids(), k=5)
+    # flows fall off with distance
+    distance = np.abs(np.subtract.outer(np.arange(5), np.arange(5)))
+    flows = scipy.sparse.csr_matrix(np.exp(-0.7 * distance))
+
+    sampler = gravity_model.GravityDestinationSampler.from_matrix(flows, neighbours)
+
+    rates = gravity_model.normalise_csr_rows(flows)
+    observed = np.sum(rates.multiply(distance)) / 5
+    assert np.isclose(gravity_model.expected_distance(neighbours, sampler.attractiveness, sampler.beta,
+                                                      np.arange(5)), observed, atol=1e-4)
+    probabilities = sampler.probabilities(np.arange(5)).toarray()
+    assert np.allclose(probabilities.sum(axis=1), 1.)
+    assert np.all(np.argmax(probabilities, axis=1) == np.arange(5))
+
+    u = np.random.RandomState(12345).random_sample(20000)
+    choices = sampler.sample(np.full(len(u), 2), u)
+    assert np.allclose(np.bincount(choices, minlength=5) / len(u), probabilities[2], atol=0.01)
+
+
+def test_GravityDestinationSampler_truncated_candidates():
+    neighbours = gravity_model.MSOANeighbours.from_centroids(make_centroids(), k=2)
+    # everybody moves to the far end, further than the two nearest candidates allow
+    flows = scipy.sparse.csr_matrix((np.ones(5), (np.arange(5), np.full(5, 4))), shape=(5, 5))
+
+    sampler = gravity_model.GravityDestinationSampler.from_matrix(flows, neighbours)
+
+    assert sampler.beta == 0.
+    assert set(sampler.sample(np.zeros(1000, dtype=int), np.linspace(0, 1, 1000, endpoint=False))) <= {0, 1}
+
+
+def test_read_MSOA_centroids():
+    centroids = gravity_model.read_MSOA_centroids(
+        'persistant_data/Middle_Layer_Super_Output_Areas__December_2001__Population_Weighted_Centroids.csv')
+
+    assert list(centroids.columns) == ['X', 'Y']
+    assert centroids.loc['E02000001'].tolist() == [532458, 181630]
+
+
+def test_fill_MSOA_centroids():
+    centroids = pd.DataFrame({'X': [0., 2000.], 'Y': [0., 1000.]}, index=['E02000001', 'E02000002'])
+    MSOA_LAD = pd.Series(['E08000001', 'E08000002', 'E08000001'], index=['E02000002', 'E02006782', 'E02000001'])
+
+    with pytest.raises(ValueError):
+        gravity_model.fill_MSOA_centroids(centroids, MSOA_LAD)
+
+    MSOA_LAD['E02006782'] = 'E08000001'
+    filled = gravity_model.fill_MSOA_centroids(centroids, MSOA_LAD)
+    assert list(filled.index) == list(MSOA_LAD.index)
+    assert filled.loc['E02006782'].tolist() == [1000., 500.]
+
+
+def test_fill_MSOA_centroids_of_OD_matrices():
+    # the 2011 MSOAs created since 2001 are placed in their LAD
+    centroids = gravity_model.read_MSOA_centroids(
+        'persistant_data/Middle_Layer_Super_Output_Areas__December_2001__Population_Weighted_Centroids.csv')
+    OD_MSOAs = pd.read_csv('persistant_data/od_matrices/MSOA_to_OD_index.csv', index_col=0).index
+    MSOA_LAD = pd.read_csv(
+        'persistant_data/Middle_Layer_Super_Output_Area__2011__to_Ward__2016__Lookup_in_England_and_Wales.csv'
+    ).drop_duplicates('MSOA11CD').set_index('MSOA11CD')['LAD16CD'].reindex(OD_MSOAs)
+
+    filled = gravity_model.fill_MSOA_centroids(centroids, MSOA_LAD)
+    assert (~OD_MSOAs.isin(centroids.index)).sum() == 161
+    assert filled.notna().all().all() and list(filled.index) == list(OD_MSOAs)
+    assert len(gravity_model.MSOANeighbours.from_centroids(filled, k=10).indptr) == len(OD_MSOAs) + 1
+
+
+def test_GravityDestinationSampler_km_distances():
+    # importing vivarium makes numpy raise on underflow, as in a simulation
+    import vivarium  # noqa: F401
+    assert np.geterr()['under'] == 'raise'
+
+    # MSOAs a few km apart over a 200 km square, with moves mostly to the nearest ones
+    r = np.random.RandomState(12345)
+    centroids = r.uniform(0, 200000, size=(400, 2))
+    neighbours = gravity_model.MSOANeighbours.from_centroids(centroids, k=50)
+    distance = np.hypot(*(centroids[:, None] - centroids[None, :]).T) / 1000.
+    flows = scipy.sparse.csr_matrix(np.where(distance < 15, np.exp(-2. * distance), 0.))
+
+    sampler = gravity_model.GravityDestinationSampler.from_matrix(flows, neighbours)
+
+    assert 0 < sampler.beta < 100
+    probabilities = sampler.probabilities(np.arange(400)).toarray()
+    assert np.allclose(probabilities.sum(axis=1), 1.)
+    assert np.all(np.isfinite(gravity_model.gravity_weights(np.ones(3), np.array([0., 500., 1000.]), 100.,
+                                                             np.array([3]))))
@@ -9,6 +9,7 @@ from vivarium_population_spenser.population.spenser_population import transform_
 from vivarium_population_spenser.population.spenser_population import prepare_dataset
 from vivarium_population_spenser.population.spenser_population import compute_migration_rates
 from vivarium_population_spenser.population import ImmigrationDeterministic as Immigration
+from vivarium_population_spenser.population.immigration import arrival_counts, build_immigration_MSOA_sampler
 
 
 
@@ -92,4 +93,39 @@ def test_Immigration(config, base_plugins):
 
     assert (len(pop["entrance_time"].value_counts()) > 1)
 
-    print (pop)
\ No newline at end of file
+    print (pop)
+
+
+def test_build_immigration_MSOA_sampler():
+    immigration_to_MSOA = pd.read_csv('persistant_data/Immigration_MSOA_M_F.csv')
+    sampler, LADs, MSOAs = build_immigration_MSOA_sampler(immigration_to_MSOA)
+
+    # females aged 20 to 24 immigrating into two LADs in one batch
+    LAD = LADs.get_indexer(['E08000032', 'E06000009'])
+    rows = np.repeat((LAD * 2 + 1) * 9 + 3, 20000)
+    u = np.random.RandomState(12345).random_sample(len(rows))
+    choices = MSOAs[sampler.sample(rows, u)]
+
+    MSOA_LAD = immigration_to_MSOA.set_index('MSOA')['LAD.Code']
+    assert (MSOA_LAD[choices[:20000]].to_numpy() == 'E08000032').all()
+    assert (MSOA_LAD[choices[20000:]].to_numpy() == 'E06000009').all()
+
+    counts = immigration_to_MSOA[immigration_to_MSOA['LAD.Code'] == 'E08000032'].set_index('MSOA')['F_20_24']
+    frequencies = pd.Series(choices[:20000]).value_counts(normalize=True).reindex(counts.index, fill_value=0)
+    assert np.allclose(frequencies, counts / counts.sum(), atol=0.02)
+
+
+def test_arrival_counts():
+    simulants_per_year, step_size = 1234., 10 / 365.25
+
+    # the fractional immigrants carried over from step to step, as in the step by step schedule
+    fractional, expected = 0., []
+    for _ in range(100):
+        simulants_to_add = simulants_per_year * step_size + fractional
+        fractional = simulants_to_add % 1
+        expected.append(int(simulants_to_add))
+
+    counts = arrival_counts(simulants_per_year, step_size, 0, 100)
+    assert np.abs(counts - expected).max() <= 1 and abs(counts.sum() - sum(expected)) <= 1
+    assert np.array_equal(np.concatenate([arrival_counts(simulants_per_year, step_size, 0, 37),
+                                          arrival_counts(simulants_per_year, step_size, 37, 63)]), counts)
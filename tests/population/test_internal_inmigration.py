@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from vivarium_population_spenser.population.internal_inmigration import (InternalInMigration, external_inflow,
+                                                                         sample_donors)
+
+
+def test_external_inflow():
+    flows = scipy.sparse.csr_matrix(np.array([[1., 2., 0., 4.],
+                                              [3., 5., 1., 0.],
+                                              [0., 7., 2., 1.],
+                                              [6., 0., 1., 8.]]))
+
+    # flows between the study area MSOAs 1 and 3 are left out
+    assert np.array_equal(external_inflow(flows, np.array([1, 3])), [9., 5.])
+
+
+def test_sample_donors():
+    resident_MSOA = np.array(['E02000002', 'E02000001', 'E02000002', 'E02000003'])
+    MSOA = np.array(['E02000002', 'E02000002', 'E02000001', 'E02000009'])
+    u = np.array([0.25, 0.75, 0.5, 0.99])
+
+    donors = sample_donors(resident_MSOA, MSOA, u)
+
+    # an MSOA without residents takes a donor from anywhere
+    assert np.array_equal(donors, [0, 2, 1, 3])
+
+    # no residents at all
+    assert np.array_equal(sample_donors(np.array([], dtype=str), MSOA, u), [-1, -1, -1, -1])
+
+
+class PopulationView:
+
+    def __init__(self, state):
+        self.state = state
+
+    def get(self, index, query=''):
+        return self.state.loc[index].query(query) if query else self.state.loc[index]
+
+
+def test_read_inflow(tmp_path):
+    flows = scipy.sparse.csr_matrix(np.array([[0., 2., 3.],
+                                              [0., 0., 0.],
+                                              [1., 4., 0.]]))
+    scipy.sparse.save_npz(str(tmp_path / 'F_0to4_OD_matrix_EW.npz'), flows)
+
+    inmigration = InternalInMigration()
+    inmigration.internal_migration_MSOA_location_dict = {0: 'E02000001', 1: 'E02000002', 2: 'E02006782'}
+    inmigration.internal_migration_LAD_location_dict = {0: 'E09000001', 1: 'E09000033', 2: 'E08000035'}
+    inmigration.path_to_OD_matrices = str(tmp_path)
+    inmigration.OD_matrix_family = 'OD_matrix'
+    inmigration.study_area = None
+    # the population holds the merged code of the City of London and Westminster, as the rates do
+    inmigration.population_view = PopulationView(pd.DataFrame({'alive': 'alive', 'sex': 2.,
+                                                               'location': 'E09000001+E09000033',
+                                                               'MSOA': 'E02000001', 'ethnicity': 'WBI'},
+                                                              index=range(2)))
+
+    inflow = inmigration.read_inflow(pd.RangeIndex(2))
+
+    assert inflow['MSOA'].tolist() == ['E02000001', 'E02000002']
+    assert inflow['location'].tolist() == ['E09000001+E09000033'] * 2
+    assert inflow['inflow'].tolist() == [1., 4.]
+    assert len(inmigration.initial_residents) == 2
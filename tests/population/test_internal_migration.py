@@ -8,6 +8,8 @@ import wget
 from vivarium import InteractiveContext
 from vivarium_population_spenser.population.spenser_population import TestPopulation, prepare_dataset, transform_rate_table
 from vivarium_population_spenser.population import InternalMigration
+from vivarium_population_spenser.population.gravity_model import read_MSOA_centroids
+from vivarium_population_spenser.population.internal_migration import MigrationEventLog
 
 
 @pytest.fixture()
@@ -33,6 +35,7 @@ def config(base_config):
     path_msoa_to_lad = os.path.join(path_dir, 'Middle_Layer_Super_Output_Area__2011__to_Ward__2016__Lookup_in_England_and_Wales.csv')
     path_to_OD_matrices = os.path.join(path_dir, "od_matrices")
     path_to_OD_matrix_index_file = os.path.join(path_to_OD_matrices,'MSOA_to_OD_index.csv')
+    path_to_MSOA_centroids = os.path.join(path_dir, 'Middle_Layer_Super_Output_Areas__December_2001__Population_Weighted_Centroids.csv')
 
 
 
@@ -42,6 +45,7 @@ def config(base_config):
         'path_msoa_to_lad': path_msoa_to_lad,
         'path_to_OD_matrices': path_to_OD_matrices,
         'path_to_OD_matrix_index_file': path_to_OD_matrix_index_file,
+        'path_to_MSOA_centroids': path_to_MSOA_centroids,
         'population': {
             'population_size': pop_size,
             'age_start': 0,
@@ -56,10 +60,13 @@ def config(base_config):
 @pytest.mark.skipif("TRAVIS" in os.environ and os.environ["TRAVIS"] == "true", "Skipping this test on Travis CI.",
                     reason='CI doesnt have enough memory to run this.')
 
-def test_internal_outmigration(config, base_plugins):
+@pytest.mark.parametrize('destination_sampler', ['msoa', 'gravity'])
+def test_internal_outmigration(config, base_plugins, destination_sampler):
 
     num_days = 365*5
-    components = [TestPopulation(), InternalMigration()]
+    config.update({'internal_migration': {'destination_sampler': destination_sampler}})
+    internal_migration = InternalMigration()
+    components = [TestPopulation(), internal_migration]
     simulation = InteractiveContext(components=components,
                                     configuration=config,
                                     plugin_configuration=base_plugins,
@@ -96,6 +103,7 @@ def test_internal_outmigration(config, base_plugins):
     simulation._data.write("internal_migration.LAD_index", LAD_location_index)
     simulation._data.write("internal_migration.MSOA_LAD_indices", OD_matrix_with_LAD)
     simulation._data.write("internal_migration.path_to_OD_matrices", config.path_to_OD_matrices)
+    simulation._data.write("internal_migration.path_to_MSOA_centroids", config.path_to_MSOA_centroids)
 
     simulation.setup()
 
@@ -109,4 +117,46 @@ def test_internal_outmigration(config, base_plugins):
     assert (np.all(pop.internal_outmigration == 'Yes') == False)
 
     assert len(pop[pop['last_outmigration_time']!='NaT']) > 0, 'time of out migration gets saved.'
-    assert len(pop[pop['previous_MSOA_locations']!='']) > 0, 'previous location of the migrant gets saved.'
\ No newline at end of file
+    events = internal_migration.migration_log.to_frame()
+    assert len(events) > 0, 'previous location of the migrant gets saved.'
+    assert set(events['simulant_id']) == set(pop.index[pop['internal_outmigration'] == 'Yes'])
+    last_move = events.drop_duplicates('simulant_id', keep='last').set_index('simulant_id')
+    assert (last_move['to_MSOA'].astype(str) == pop.loc[last_move.index, 'MSOA']).all()
+
+
+def test_MigrationEventLog():
+    log = MigrationEventLog()
+    assert len(log) == 0 and log.to_frame().empty
+
+    log.record([3, 5], pd.Timestamp('2011-01-11'), ['E02000001', 'E02000002'], ['E02000002', 'E02000003'],
+               ['E09000001', 'E09000002'], ['E09000002', 'E09000002'])
+    log.record([3], pd.Timestamp('2012-02-01'), ['E02000002'], ['E02000001'], ['E09000002'], ['E09000001'])
+
+    events = log.to_frame()
+    assert len(log) == 3
+    assert list(events.columns) == MigrationEventLog.columns
+    assert list(events['to_MSOA']) == ['E02000002', 'E02000003', 'E02000001']
+    assert list(events['from_LAD']) == ['E09000001', 'E09000002', 'E09000002']
+
+    history = log.history([3])
+    assert list(history['time']) == [pd.Timestamp('2011-01-11'), pd.Timestamp('2012-02-01')]
+    assert list(history['from_MSOA']) == ['E02000001', 'E02000002']
+
+def test_build_MSOA_neighbours(config):
+    # every OD matrix MSOA gets candidates, the ones created in 2011 through the centroid of their LAD
+    msoa_lad_df = pd.read_csv(config.path_msoa_to_lad)
+    OD_matrix_dest = pd.read_csv(config.path_to_OD_matrix_index_file, index_col=0)
+    OD_matrix_with_LAD = OD_matrix_dest.merge(msoa_lad_df[["MSOA11CD", "LAD16CD"]], left_index=True,
+                                              right_on="MSOA11CD").set_index("indices", drop=False)
+
+    internal_migration = InternalMigration()
+    internal_migration.internal_migration_MSOA_location_dict = OD_matrix_with_LAD["MSOA11CD"].to_dict()
+    internal_migration.internal_migration_LAD_location_dict = OD_matrix_with_LAD["LAD16CD"].to_dict()
+    centroids = read_MSOA_centroids(config.path_to_MSOA_centroids)
+
+    neighbours = internal_migration.build_MSOA_neighbours(centroids, k=10, radius=None)
+    assert neighbours.n_origins == len(OD_matrix_dest)
+    origins = np.repeat(np.arange(neighbours.n_origins), np.diff(neighbours.indptr))
+    # MSOAs placed at the centroid of their LAD share it, so each is among the nearest of the others
+    assert np.unique(origins[neighbours.indices == origins]).size == neighbours.n_origins
+    assert (neighbours.distances[neighbours.indices == origins] == 0).all()
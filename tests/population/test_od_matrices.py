@@ -0,0 +1,422 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+from vivarium_population_spenser.population import od_matrices
+
+
+def make_od_matrices():
+    first = np.array([[0., 2., 2., 0.],
+                      [0., 0., 0., 0.],
+                      [1., 0., 0., 3.]])
+    second = np.array([[4., 0., 0., 0.],
+                       [0., 1., 1., 0.],
+                       [0., 0., 5., 0.]])
+    return [first, second]
+
+
+def test_normalise_csr_rows():
+    rates = od_matrices.normalise_csr_rows(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+
+    assert np.allclose(np.asarray(rates.sum(axis=1)).ravel(), [1., 0., 1.])
+
+
+def test_DestinationSampler_sparse():
+    sampler = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+    u = np.array([0.1, 0.6, 0.1, 0.2, 0.9, 0.3])
+    rows = np.array([0, 0, 2, 2, 2, 1])
+
+    # the row without flows is sampled uniformly over all destinations
+    assert np.array_equal(sampler.sample(rows, u), [1, 2, 0, 0, 3, 1])
+
+
+def test_DestinationSampler_dense():
+    sampler = od_matrices.DestinationSampler.from_matrix(make_od_matrices()[0])
+    u = np.array([0.1, 0.6, 0.1, 0.2, 0.9, 0.3])
+    rows = np.array([0, 0, 2, 2, 2, 1])
+
+    assert sampler.is_dense
+    assert np.array_equal(sampler.sample(rows, u), [1, 2, 0, 0, 3, 1])
+
+
+def test_DestinationSampler_frequencies():
+    sampler = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+    u = np.random.RandomState(12345).random_sample(20000)
+
+    choices = sampler.sample(np.full(len(u), 2), u)
+
+    assert set(np.unique(choices)) == {0, 3}
+    assert np.isclose(np.mean(choices == 3), 0.75, atol=0.01)
+
+
+def test_gather_probabilities():
+    dense = make_od_matrices()
+    samplers = [od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(m)) for m in dense]
+    matrix_index = np.array([1, 0, 1, 0])
+    row_index = np.array([2, 0, 0, 2])
+
+    rates = od_matrices.gather_probabilities(samplers, matrix_index, row_index)
+
+    expected = np.array([dense[m][r] / dense[m][r].sum() for m, r in zip(matrix_index, row_index)])
+    assert scipy.sparse.issparse(rates)
+    assert np.allclose(rates.toarray(), expected)
+
+
+def test_sample_destinations():
+    samplers = [od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(m)) for m in make_od_matrices()]
+    matrix_index = np.array([1, 0, 1, 0])
+    row_index = np.array([2, 0, 1, 2])
+    u = np.array([0.5, 0.75, 0.25, 0.5])
+
+    choices = od_matrices.sample_destinations(samplers, matrix_index, row_index, u)
+
+    assert np.array_equal(choices, [2, 2, 1, 3])
+
+
+def test_OD_store_roundtrip(tmp_path):
+    samplers = {f'matrix_{i}': od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(m))
+                for i, m in enumerate(make_od_matrices())}
+    samplers['dense'] = od_matrices.DestinationSampler.from_matrix(make_od_matrices()[0])
+    MSOA_index = {'E02000001': 0, 'E02000002': 1, 'E02000003': 2}
+    path = str(tmp_path / od_matrices.OD_STORE_FILE.format(family='prob_matrix'))
+
+    od_matrices.write_OD_store(path, samplers, MSOA_index)
+    stored, stored_MSOA_index = od_matrices.read_OD_store(path)
+
+    assert stored_MSOA_index == MSOA_index
+    assert set(stored) == set(samplers)
+    rows = np.array([0, 0, 2, 2, 1])
+    u = np.array([0.1, 0.6, 0.1, 0.9, 0.3])
+    for name, sampler in samplers.items():
+        assert isinstance(stored[name].cdf, np.memmap)
+        assert stored[name].is_dense == sampler.is_dense
+        assert np.array_equal(stored[name].sample(rows, u), sampler.sample(rows, u))
+
+
+def test_LazyODMatrices():
+    dense = make_od_matrices()
+    read = []
+
+    def load(file):
+        read.append(file)
+        return od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(dense[file]))
+
+    samplers = od_matrices.LazyODMatrices([0, 1], load, max_loaded=1)
+    assert len(samplers) == 2 and samplers.loaded == [] and read == []
+
+    choices = od_matrices.sample_destinations(samplers, np.array([1, 1]), np.array([2, 0]), np.array([0.5, 0.5]))
+    assert np.array_equal(choices, [2, 0])
+    assert samplers.loaded == [1] and read == [1]
+
+    samplers[1]
+    samplers[0]
+    assert samplers.loaded == [0] and read == [1, 0]
+
+
+def test_DestinationSampler_take_rows_and_append():
+    sampler = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+
+    subset = sampler.take_rows([2]).append(sampler.take_rows([1, 0]))
+
+    assert subset.n_origins == 3
+    assert np.allclose(subset.probabilities([0, 1, 2]).toarray(), sampler.probabilities([2, 1, 0]).toarray())
+
+
+def test_OriginSubsetSampler():
+    sampler = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+    requested = []
+
+    def load_rows(rows):
+        requested.append(list(rows))
+        return sampler.take_rows(rows)
+
+    subset = od_matrices.OriginSubsetSampler(load_rows, sampler.n_origins)
+    subset.add_rows([2, 2])
+    assert np.array_equal(subset.origins, [2])
+
+    rows = np.array([0, 2, 2, 0])
+    u = np.array([0.1, 0.1, 0.9, 0.6])
+    assert np.array_equal(subset.sample(rows, u), sampler.sample(rows, u))
+    assert np.array_equal(subset.origins, [0, 2])
+    assert requested == [[2], [0]]
+
+
+def test_OD_matrix_lookup():
+    map_OD_file2index = {'F_0to4_prob_matrix_EW.npz': 0, 'M_75plus_prob_matrix_EW.npz': 1,
+                         'M_0to4_OD_matrix_EW.npz': 2}
+    lookup = od_matrices.build_OD_matrix_lookup(map_OD_file2index)
+
+    sex = np.array([2, 1, 2, 1])
+    age = np.array([0.5, 80., 5., 0.5])
+    assert np.array_equal(od_matrices.OD_age_bucket_codes(age), [0, 8, 0, 0])
+    assert np.array_equal(lookup[sex, od_matrices.OD_age_bucket_codes(age)], [0, 1, 0, -1])
+
+
+def test_DestinationSampler_residual():
+    sampler = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+
+    choices, residual = sampler.sample_with_residual(np.array([2, 2, 0]), np.array([0.125, 0.625, 0.75]))
+
+    assert np.array_equal(choices, [0, 3, 2])
+    assert np.allclose(residual, [0.5, 0.5, 0.5])
+
+
+def test_HierarchicalDestinationSampler():
+    matrix = scipy.sparse.csr_matrix(np.array([[0., 1., 1., 2.],
+                                               [3., 0., 0., 1.],
+                                               [0., 0., 0., 0.],
+                                               [1., 1., 2., 0.]]))
+    column_LAD = pd.Series({0: 'E1', 1: 'E1', 2: 'E2', 3: 'E2'})
+    sampler = od_matrices.HierarchicalDestinationSampler.from_matrix(matrix, column_LAD)
+
+    # moves within the LAD of the origin are exact, moves from E1 to E2 follow the inflows into
+    # MSOAs 2 and 3 from the origins of E1, 0.25 and 0.75
+    expected = np.array([[0., 0.25, 0.75 * 0.25, 0.75 * 0.75],
+                         [0.75, 0., 0.25 * 0.25, 0.25 * 0.75],
+                         [0.25, 0.25, 0.5, 0.]])
+    assert np.allclose(sampler.probabilities([0, 1, 3]).toarray(), expected)
+
+    u = np.random.RandomState(12345).random_sample(40000)
+    for row in [0, 1]:
+        choices = sampler.sample(np.full(len(u), row), u)
+        assert np.allclose(np.bincount(choices, minlength=4) / len(u), expected[row], atol=0.01)
+
+    subset = sampler.take_rows([1]).append(sampler.take_rows([0]))
+    assert np.allclose(subset.probabilities([0, 1]).toarray(), expected[[1, 0]])
+    assert np.allclose(sampler.astype('uint16').probabilities([0, 1, 3]).toarray(), expected, atol=1e-4)
+
+
+def test_HierarchicalDestinationSampler_exact_parts():
+    # moves within the LAD of the origin and the LAD marginals are exact, only the MSOA of moves between LADs is not
+    r = np.random.RandomState(12345)
+    matrix = scipy.sparse.csr_matrix(r.random_sample((40, 40)) * (r.random_sample((40, 40)) < 0.3))
+    column_LAD = pd.Series(np.repeat(['E1', 'E2', 'E3', 'E4'], 10))
+    sampler = od_matrices.HierarchicalDestinationSampler.from_matrix(matrix, column_LAD)
+
+    exact = od_matrices.normalise_csr_rows(matrix).toarray()
+    probabilities = sampler.probabilities(np.arange(40)).toarray()
+    LAD = np.repeat(np.arange(4), 10)
+    within = LAD[:, None] == LAD[None, :]
+    assert np.allclose(probabilities[within], exact[within])
+    assert np.allclose((probabilities @ (LAD[:, None] == np.arange(4))), exact @ (LAD[:, None] == np.arange(4)))
+
+
+def write_OD_csvs(path, matrices, MSOAs):
+    for name, matrix in matrices.items():
+        pd.DataFrame(matrix, index=pd.Index(MSOAs, name='MSOA'), columns=MSOAs).to_csv(path / name)
+
+
+def test_compile_OD_csvs(tmp_path):
+    MSOAs = ['E02000001', 'E02000002', 'E02000003']
+    square = {'F_0to4_prob_matrix_EW.csv': np.array([[0., .5, .5], [0., 0., 1.], [1., 0., 0.]]),
+              'M_0to4_prob_matrix_EW.csv': np.array([[1., 0., 0.], [0., .5, .5], [0., 0., 1.]]),
+              'M_0to4_OD_matrix_EW.csv': np.array([[4., 0., 0.], [0., 1., 1.], [0., 0., 5.]])}
+    write_OD_csvs(tmp_path, square, MSOAs)
+
+    path = od_matrices.compile_OD_csvs(str(tmp_path), chunksize=2, processes=2)
+    samplers, MSOA_index = od_matrices.read_OD_store(path)
+
+    assert MSOA_index == {'E02000001': 0, 'E02000002': 1, 'E02000003': 2}
+    assert sorted(samplers) == ['F_0to4_prob_matrix_EW.npz', 'M_0to4_prob_matrix_EW.npz']
+    for name, sampler in samplers.items():
+        assert np.allclose(sampler.probabilities([0, 1, 2]).toarray(), square[name.replace('.npz', '.csv')])
+
+
+def test_compile_OD_csvs_validation(tmp_path):
+    MSOAs = ['E02000001', 'E02000002']
+    write_OD_csvs(tmp_path, {'F_0to4_prob_matrix_EW.csv': np.array([[1., -1.], [0., 2.]])}, MSOAs)
+
+    with pytest.raises(ValueError):
+        od_matrices.compile_OD_csvs(str(tmp_path), processes=1)
+
+
+@pytest.mark.parametrize('matrix, columns', [
+    (np.array([[.5, .5], [0., .9]]), ['E02000001', 'E02000002']),
+    (np.array([[.5, .5], [0., 1.]]), ['E02000002', 'E02000001']),
+])
+def test_read_OD_csv_validation(tmp_path, matrix, columns):
+    # probabilities not summing to one and destinations in another order
+    pd.DataFrame(matrix, index=pd.Index(['E02000001', 'E02000002'], name='MSOA'),
+                 columns=columns).to_csv(tmp_path / 'F_0to4_prob_matrix_EW.csv')
+
+    with pytest.raises(ValueError):
+        od_matrices.read_OD_csv(str(tmp_path / 'F_0to4_prob_matrix_EW.csv'), row_sum_tolerance=1e-6)
+    # the row sums are only checked on request, rows are normalised anyway
+    if columns[0] == 'E02000001':
+        rates, _ = od_matrices.read_OD_csv(str(tmp_path / 'F_0to4_prob_matrix_EW.csv'))
+        assert np.allclose(rates.toarray(), [[.5, .5], [0., 1.]])
+
+
+def test_read_OD_csv_empty_origin(tmp_path):
+    pd.DataFrame(np.array([[1., 0.], [0., 0.]]), index=pd.Index(['E02000001', 'E02000002'], name='MSOA'),
+                 columns=['E02000001', 'E02000002']).to_csv(tmp_path / 'F_0to4_OD_matrix_EW.csv')
+
+    with pytest.warns(UserWarning):
+        rates, _ = od_matrices.read_OD_csv(str(tmp_path / 'F_0to4_OD_matrix_EW.csv'), row_sum_tolerance=1e-6)
+    assert np.allclose(rates.toarray(), [[1., 0.], [0., 0.]])
+
+
+@pytest.mark.parametrize('family', ['prob_matrix', 'OD_matrix'])
+def test_compile_OD_csvs_of_repo_matrices(tmp_path, family):
+    # the shipped matrices, with rows summing to less than one and origins without flows, compile
+    matrix = scipy.sparse.load_npz(f'persistant_data/od_matrices/M_75plus_{family}_EW.npz').tocsr()[:300, :300].toarray()
+    MSOAs = pd.read_csv('persistant_data/od_matrices/MSOA_to_OD_index.csv', index_col=0).index[:300]
+    write_OD_csvs(tmp_path, {f'M_75plus_{family}_EW.csv': matrix}, list(MSOAs))
+
+    path = od_matrices.compile_OD_csvs(str(tmp_path), family=family, processes=1)
+    samplers, _ = od_matrices.read_OD_store(path)
+    has_flows = matrix.sum(axis=1) > 0
+    probabilities = samplers[f'M_75plus_{family}_EW.npz'].probabilities(np.flatnonzero(has_flows)).toarray()
+    assert np.allclose(probabilities, matrix[has_flows] / matrix[has_flows].sum(axis=1, keepdims=True))
+
+
+@pytest.mark.parametrize('precision, tolerance', [('float32', 1.2e-7), ('uint16', 1. / 65535)])
+def test_DestinationSampler_precision(precision, tolerance):
+    rates = np.random.RandomState(12345).random_sample((20, 50)) ** 4
+    exact = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(rates))
+    reduced = exact.astype(precision)
+
+    assert reduced.precision == precision
+    assert reduced.nbytes < exact.nbytes
+
+    # every destination probability is within the documented error of the exact one
+    rows = np.arange(exact.n_origins)
+    error = np.abs(reduced.probabilities(rows).toarray() - exact.probabilities(rows).toarray())
+    assert error.max() <= tolerance
+
+    # the same draw only picks another destination when it falls within the error of a boundary
+    u = np.random.RandomState(54321).random_sample(20000)
+    rows = np.repeat(rows, len(u) // exact.n_origins)
+    assert np.mean(reduced.sample(rows, u) != exact.sample(rows, u)) <= 50 * tolerance
+
+
+def test_OD_store_uint16(tmp_path):
+    sampler = od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(make_od_matrices()[0]))
+    path = str(tmp_path / od_matrices.OD_STORE_FILE.format(family='prob_matrix'))
+
+    od_matrices.write_OD_store(path, {'matrix': sampler.astype('uint16')}, {'E02000001': 0})
+    stored = od_matrices.read_OD_store(path)[0]['matrix']
+
+    assert stored.precision == 'uint16'
+    rows = np.array([0, 0, 2, 2, 1])
+    u = np.array([0.1, 0.6, 0.1, 0.9, 0.3])
+    assert np.array_equal(stored.sample(rows, u), sampler.sample(rows, u))
+
+
+def test_sample_destination_counts():
+    dense = make_od_matrices()
+    samplers = [od_matrices.DestinationSampler.from_matrix(scipy.sparse.csr_matrix(m)) for m in dense]
+    matrix_index = np.tile([0, 1, 0], 10000)
+    row_index = np.tile([2, 1, 1], 10000)
+
+    choices = od_matrices.sample_destination_counts(samplers, matrix_index, row_index, np.random.RandomState(12345))
+
+    first_cell = choices[0::3]
+    assert set(np.unique(first_cell)) == {0, 3}
+    assert np.isclose(np.mean(first_cell == 3), 0.75, atol=0.01)
+    assert set(np.unique(choices[1::3])) == {1, 2}
+    # the row without flows is sampled uniformly over all destinations
+    assert np.allclose(np.bincount(choices[2::3], minlength=4) / 10000, 0.25, atol=0.02)
+
+
+def test_YearlyODMatrices():
+    read = []
+
+    def load(year):
+        read.append((year, threading.get_ident()))
+        return f'matrices of {year}'
+
+    sets = od_matrices.YearlyODMatrices([2013, 2011, 2012], load)
+    assert sets.year_in_force(2010) == 2011 and sets.year_in_force(2020) == 2013
+
+    assert sets.swap(2011)
+    assert sets.current == 'matrices of 2011'
+    assert not sets.swap(2011)
+
+    # the following year is read on the background thread and picked up at the boundary
+    assert sets.swap(2012)
+    assert sets.current == 'matrices of 2012'
+    assert sets.swap(2020)
+    assert sets.current == 'matrices of 2013'
+    sets.close()
+
+    assert [year for year, _ in read] == [2011, 2012, 2013]
+    assert read[0][1] == threading.get_ident()
+    assert all(thread != threading.get_ident() for _, thread in read[1:])
+
+
+def make_truncation_case():
+    matrix = scipy.sparse.csr_matrix(np.array([[5., 3., 1., 1.],
+                                               [0., 0., 0., 0.],
+                                               [1., 0., 6., 3.]]))
+    column_LAD = pd.Series({0: 'E1', 1: 'E1', 2: 'E2', 3: 'E2'})
+    return matrix, column_LAD
+
+
+def test_TruncatedDestinationSampler():
+    matrix, column_LAD = make_truncation_case()
+    sampler = od_matrices.TruncatedDestinationSampler.from_matrix(matrix, column_LAD, k=1)
+
+    # the residual is spread by LAD marginal and LAD inflow, so the LAD totals are exact
+    probabilities = sampler.probabilities([0, 2]).toarray()
+    assert np.allclose(probabilities[:, :2].sum(axis=1), [0.8, 0.1])
+    assert np.allclose(probabilities[:, 2:].sum(axis=1), [0.2, 0.9])
+    assert probabilities[0, 0] >= 0.5 and probabilities[1, 2] >= 0.6
+
+    u = np.random.RandomState(12345).random_sample(40000)
+    choices = sampler.sample(np.zeros(len(u), dtype=int), u)
+    assert np.allclose(np.bincount(choices, minlength=4) / len(u), probabilities[0], atol=0.01)
+    # the row without flows is sampled uniformly over the destinations, never the bucket
+    assert np.allclose(np.bincount(sampler.sample(np.ones(len(u), dtype=int), u)) / len(u), 0.25, atol=0.01)
+
+    exact = od_matrices.TruncatedDestinationSampler.from_matrix(matrix, column_LAD, k=4)
+    assert np.allclose(exact.probabilities([0, 2]).toarray(),
+                       od_matrices.normalise_csr_rows(matrix)[[0, 2]].toarray())
+
+
+def test_destination_models_of_rows():
+    matrix, column_LAD = make_truncation_case()
+    rows = np.array([2, 0])
+
+    hierarchical = od_matrices.HierarchicalDestinationSampler.from_matrix(matrix, column_LAD)
+    hierarchical_rows = od_matrices.HierarchicalDestinationSampler.from_matrix(matrix, column_LAD, rows)
+    shared = od_matrices.HierarchicalDestinationSampler.from_matrix(matrix, column_LAD, [1],
+                                                                    MSOA_sampler=hierarchical.MSOA_sampler)
+    assert np.allclose(hierarchical_rows.probabilities([0, 1]).toarray(), hierarchical.probabilities(rows).toarray())
+    assert shared.MSOA_sampler is hierarchical.MSOA_sampler
+    assert np.allclose(shared.probabilities([0]).toarray(), hierarchical.probabilities([1]).toarray())
+
+    truncated = od_matrices.TruncatedDestinationSampler.from_matrix(matrix, column_LAD, k=1)
+    truncated_rows = od_matrices.TruncatedDestinationSampler.from_matrix(matrix, column_LAD, 1, rows)
+    shared = od_matrices.TruncatedDestinationSampler.from_matrix(
+        matrix, column_LAD, 1, rows, residual_MSOA_sampler=truncated.residual_sampler.MSOA_sampler)
+    for sampler in [truncated_rows, shared]:
+        assert np.allclose(sampler.probabilities([0, 1]).toarray(), truncated.probabilities(rows).toarray())
+
+
+def test_ODMatrixFile(tmp_path, monkeypatch):
+    file = str(tmp_path / 'M_0to4_prob_matrix_EW.npz')
+    scipy.sparse.save_npz(file, scipy.sparse.csr_matrix(make_od_matrices()[0]))
+    reads = []
+    load_npz = scipy.sparse.load_npz
+    monkeypatch.setattr(scipy.sparse, 'load_npz', lambda path: reads.append(path) or load_npz(path))
+
+    OD_file = od_matrices.ODMatrixFile(file)
+    assert np.allclose(OD_file.matrix[[2]].toarray(), make_od_matrices()[0][[2]])
+    assert np.allclose(OD_file.matrix[[0, 1]].toarray(), make_od_matrices()[0][[0, 1]])
+    assert reads == [file]
+
+
+def test_truncation_error_report():
+    matrix, column_LAD = make_truncation_case()
+
+    report = od_matrices.truncation_error_report(matrix, column_LAD, [1, 2, 4], chunksize=1)
+
+    assert list(report.index) == [1, 2, 4]
+    assert np.allclose(report['mean_residual_mass'], [0.45, 0.15, 0.])
+    assert (report['max_total_variation'] <= report['mean_residual_mass'] * 2 + 1e-12).all()
+    assert np.isclose(report.loc[4, 'max_total_variation'], 0.)
+    assert np.all(np.diff(report['mean_total_variation']) <= 1e-12)
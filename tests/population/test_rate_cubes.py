@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium.interpolation import Interpolation
+
+from vivarium_population_spenser.population.rate_cubes import CellRateTable, RateCube
+
+
+def make_rate_table():
+    rows = []
+    for sex in [1, 2]:
+        for location in ['E08000032', 'E08000033']:
+            for age in range(0, 3):
+                rows.append({'sex': sex, 'location': location, 'ethnicity': 'WBI', 'age_start': age,
+                             'age_end': age + 1, 'year_start': 2011, 'year_end': 2013,
+                             'mean_value': 100 * sex + 10 * age + (location == 'E08000033')})
+            # a wider age bin
+            rows.append({'sex': sex, 'location': location, 'ethnicity': 'WBI', 'age_start': 3, 'age_end': 5,
+                         'year_start': 2011, 'year_end': 2013,
+                         'mean_value': 100 * sex + 40 + (location == 'E08000033')})
+    return pd.DataFrame(rows)
+
+
+def test_RateCube():
+    cube = RateCube.from_table(make_rate_table())
+
+    assert cube.values.shape == (2, 2, 1, 5, 2)
+    rates = cube.rates(np.array([1., 2., 2., 1., 1.]),
+                       np.array(['E08000032', 'E08000033', 'E08000032', 'E08000032', 'E08000033']),
+                       np.array(['WBI'] * 5),
+                       np.array([0.5, 2.9, 150., 4.2, 3.5]), 2011)
+    # ages past the table take the rate of the last age
+    assert np.array_equal(rates, [100., 221., 240., 140., 141.])
+    # years past the table take the rate of the last year
+    assert np.array_equal(cube.rates([1.], ['E08000032'], ['WBI'], [3.], 2020), [140.])
+    assert np.array_equal(cube.rates([1.], ['E08000032'], ['WBI'], [1.], 2010), [110.])
+
+
+def test_RateCube_fail():
+    cube = RateCube.from_table(make_rate_table())
+
+    with pytest.raises(ValueError):
+        cube.rates([1.], ['E09000001'], ['WBI'], [1.], 2011)
+
+
+@pytest.mark.parametrize('missing', [
+    # a sex, LAD and ethnicity combination
+    lambda table: (table.sex == 2) & (table.location == 'E08000033'),
+    # an age
+    lambda table: (table.sex == 1) & (table.location == 'E08000032') & (table.age_start == 1),
+])
+def test_RateCube_missing_cells(missing):
+    table = make_rate_table()
+
+    with pytest.raises(ValueError):
+        RateCube.from_table(table[~missing(table)])
+
+
+def test_CellRateTable():
+    table = make_rate_table()
+    cell_table = CellRateTable(table, population_view=None, clock=None)
+    interpolation = Interpolation(table, ['sex', 'location', 'ethnicity'],
+                                  [('age', 'age_start', 'age_end'), ('year', 'year_start', 'year_end')],
+                                  order=0, extrapolate=True)
+
+    r = np.random.RandomState(12345)
+    pop = pd.DataFrame({'sex': r.choice([1., 2.], 1000),
+                        'location': r.choice(['E08000032', 'E08000033'], 1000),
+                        'ethnicity': 'WBI',
+                        'age': r.uniform(0, 3, 1000)}, index=np.arange(1000) * 2)
+
+    rates = cell_table.rates(pop, 2011)
+    expected = interpolation(pop.assign(year=2011.))['mean_value']
+    assert np.allclose(rates, expected)
+    assert rates.index.equals(pop.index)
+    assert len(cell_table.cell_rates) == 12
+
+    # the cells seen in the year are kept, new ones are added
+    older = pop.assign(age=pop['age'] + 1)
+    assert np.allclose(cell_table.rates(older, 2011), interpolation(older.assign(year=2011.))['mean_value'])
+    assert len(cell_table.cell_rates) == 16
+
+    cell_table.rates(pop.iloc[:10], 2012)
+    assert len(cell_table.cell_rates) <= 10
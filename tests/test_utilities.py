@@ -1,8 +1,9 @@
 from hypothesis import given
 import hypothesis.strategies as st
+import numpy as np
 import pytest
 
-from vivarium_population_spenser.utilities import EntityString, TargetString
+from vivarium_population_spenser.utilities import AliasSampler, EntityString, TargetString
 
 
 @st.composite
@@ -41,3 +42,21 @@ def test_TargetString_pass(s):
     assert t.measure == target_measure
 
 
+
+
+def test_AliasSampler():
+    weights = np.array([1., 0., 3., 6.])
+    sampler = AliasSampler(weights)
+
+    u = np.random.RandomState(12345).random_sample(100000)
+    frequencies = np.bincount(sampler.sample(u), minlength=len(weights)) / len(u)
+
+    assert np.allclose(frequencies, weights / weights.sum(), atol=0.01)
+    assert frequencies[1] == 0.
+
+
+def test_AliasSampler_fail():
+    with pytest.raises(ValueError):
+        AliasSampler([0., 0.])
+    with pytest.raises(ValueError):
+        AliasSampler([1., -1.])